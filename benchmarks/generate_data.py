@@ -0,0 +1,238 @@
+"""
+Synthetic input data for the SIMAP and STSB pipelines, shaped like the real files (which we cannot share):
+
+- simap: data/intelliprocure_all_awards.json and data/<language>_simap.csv
+- stsb: data/aviatik.json, data/bahnen_und_schiffe.json and data/decisions.csv
+
+The decision texts are German, French and Italian filler text with embedded SIMAP project IDs and notice numbers,
+respectively with STSB dates, locations, aircraft registrations, times, runways, wagons and report numbers of events.
+Only some decisions mention identifiers that can be linked, like in the real data.
+"""
+import argparse
+import json
+import random
+from pathlib import Path
+
+import pandas as pd
+
+languages = ['de', 'fr', 'it']
+
+filler_words = {
+    "de": "das Gericht zieht in Erwägung dass die Beschwerdeführerin geltend macht Vergabestelle Zuschlag Verfügung "
+          "Beschwerde Verfahren Angebot Kosten Entscheid Urteil Sachverhalt Rechtsbegehren Vorinstanz gemäss Art".split(),
+    "fr": "le tribunal considère que la recourante fait valoir adjudicateur adjudication décision recours procédure "
+          "offre frais arrêt faits conclusions autorité inférieure selon art".split(),
+    "it": "il tribunale considera che la ricorrente fa valere committente aggiudicazione decisione ricorso procedura "
+          "offerta spese sentenza fatti conclusioni autorità inferiore secondo art".split(),
+    "en": "the aircraft took off from the runway and the crew reported a technical problem during the approach "
+          "investigation final report summary".split(),  # only used for the english content of events
+}
+
+month_names = {
+    "de": ["Januar", "Februar", "März", "April", "Mai", "Juni", "Juli", "August", "September", "Oktober", "November",
+           "Dezember"],
+    "fr": ["janvier", "février", "mars", "avril", "mai", "juin", "juillet", "août", "septembre", "octobre", "novembre",
+           "décembre"],
+    "it": ["gennaio", "febbraio", "marzo", "aprile", "maggio", "giugno", "luglio", "agosto", "settembre", "ottobre",
+           "novembre", "dicembre"],
+}
+
+simap_terms = {
+    "de": {"projectID": ["Projekt-ID", "SIMAP-Nr.", "Projekt ID"], "noticeNumber": ["Meldungsnummer"]},
+    "fr": {"projectID": ["ID du projet"], "noticeNumber": ["No de la publication", "n° de la publication simap"]},
+    "it": {"projectID": ["ID del progetto"], "noticeNumber": ["N. della pubblicazione", "n. di notificazione"]},
+}
+
+courts = [('CH', 'CH_BVGE'), ('CH', 'CH_BGer'), ('ZH', 'ZH_VG'), ('BE', 'BE_VG'), ('VD', 'VD_TC'), ('TI', 'TI_TRAM')]
+
+places = ['Bern', 'Zürich', 'Belp', 'Lugano', 'Sion', 'Grenchen', 'Agno', 'Samedan', 'Bex', 'Olten', 'Birrfeld',
+          'Ecuvillens', 'Locarno', 'Buochs', 'Langenthal', 'Courtelary', 'Montricher', 'Amlikon', 'Triengen', 'Hausen']
+cantons = ['BE', 'ZH', 'TI', 'VS', 'SO', 'GR', 'AG', 'FR', 'NW', 'VD']
+aircraft = ['ROBIN DR 400/160', 'PIPER PA-28-181', 'CESSNA 172N', 'EUROCOPTER EC135', 'DIAMOND DA40', 'PILATUS PC-6',
+            'SCHEMPP-HIRTH DISCUS', 'ROBINSON R44']
+operations = ['SchulungFlugregeln: VFR', 'PrivatFlugregeln: VFR', 'KommerziellFlugregeln: IFR',
+              'ArbeitsflugFlugregeln: VFR']
+train_types = ['Entgleisung Güterzug', 'Kollision Rangierfahrt', 'Zusammenstoss Personenzug', 'Schiffsunfall Kursschiff']
+report_titles = {"de": "Schlussbericht Nr.", "fr": "Rapport final n°", "it": "Rapporto finale n.",
+                 "en": "Final report No."}
+
+
+def filler(language: str, words: int, rng: random.Random):
+    return ' '.join(rng.choices(filler_words[language], k=words))
+
+
+def embed(text: str, mentions: list, rng: random.Random):
+    # put the mentions at random places of the filler text
+    words = text.split(' ')
+    for mention in mentions:
+        words.insert(rng.randrange(len(words) + 1), mention)
+    return ' '.join(words)
+
+
+def generate_awards(num_projects: int, rng: random.Random):
+    awards = []
+    notice_number = 100000
+    for project in range(num_projects):
+        project_id = 10000 + project
+        title = f"Projekt {project_id} {rng.choice(places)}"
+        for _ in range(rng.randint(1, 3)):
+            notice_number += rng.randint(1, 5)
+            price = rng.choice([rng.lognormvariate(13, 2), rng.lognormvariate(15, 2), float('nan')])
+            awards.append({
+                "projectID": str(project_id),
+                "noticeNumber": str(notice_number),
+                "price": str(price),
+                "bidder": f"Bidder {rng.randrange(num_projects // 4 + 1)} AG",
+                "contractor": f"Vergabestelle {rng.randrange(50)}",
+                "projectTitle": title,
+                "datePublication": f"{rng.randint(2009, 2021)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                "cpvNumber": str(rng.randint(45000000, 79999999)),
+            })
+    return awards
+
+
+def generate_simap(out_dir: Path, num_decisions: int, num_projects: int, words: int = 1000, seed: int = 0):
+    rng = random.Random(seed)
+    data_dir = out_dir / 'data'
+    data_dir.mkdir(parents=True, exist_ok=True)
+    awards = generate_awards(num_projects, rng)
+    # the export is an array whose third element holds the awards
+    with open(data_dir / 'intelliprocure_all_awards.json', 'w') as f:
+        json.dump([{"source": "synthetic"}, {"count": len(awards)}, {"data": awards}], f)
+
+    for language in languages:
+        rows = []
+        for number in range(num_decisions // len(languages)):
+            mentions = []
+            if rng.random() < 0.7:  # terms found, most of them can be re-identified
+                award = rng.choice(awards)
+                known = rng.random() < 0.8
+                if rng.random() < 0.7:
+                    project_id = award["projectID"] if known else str(rng.randint(90000, 99999))
+                    mentions.append(f"{rng.choice(simap_terms[language]['projectID'])} {project_id}")
+                if not mentions or rng.random() < 0.3:
+                    notice_number = award["noticeNumber"] if known else str(rng.randint(900000, 999999))
+                    mentions.append(f"{rng.choice(simap_terms[language]['noticeNumber'])} {notice_number}")
+            mentions.append("simap")
+            canton, court = rng.choice(courts)
+            rows.append({
+                "language": language, "canton": canton, "court": court, "chamber": f"{court}_{rng.randint(1, 6)}",
+                "date": f"{rng.randint(2007, 2021)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                "pdf_url": f"https://example.org/{language}/{number}.pdf",
+                "html_url": f"https://example.org/{language}/{number}.html",
+                "text": embed(filler(language, words, rng), mentions, rng),
+            })
+        pd.DataFrame(rows).to_csv(data_dir / f'{language}_simap.csv', index=False)
+
+
+def event_date(rng: random.Random):
+    return f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.{rng.randint(1995, 2020)}"
+
+
+def event_content(language: str, facts: dict, rng: random.Random):
+    sentences = [filler(language, 40, rng), f"{report_titles[language]} {facts['report_number']}"]
+    if language == 'de':
+        sentences.append(f"um {facts['time']} Uhr in {facts['place']}")
+        if 'runway' in facts:
+            sentences.append(f"auf der Piste {facts['runway']}")
+        if 'wagon' in facts:
+            sentences.append(f"der wagen {facts['wagon']}")
+    if language == 'fr' and 'wagon' in facts:
+        sentences.append(f"le wagon n° {facts['wagon']}")
+    return ' '.join(sentences)
+
+
+def generate_events(num_events: int, kind: str, rng: random.Random):
+    events = []
+    for event_id in range(num_events):
+        facts = {
+            "place": rng.choice(places),
+            "time": f"{rng.randint(6, 21):02d}:{rng.randint(0, 59):02d}",
+            "report_number": str(1000 + event_id) if kind == 'aviation' else str(5000 + event_id),
+        }
+        event = {"id": event_id, "event_date": event_date(rng),
+                 "location": f"{facts['place']} ({rng.choice(cantons)})"}
+        if kind == 'aviation':
+            facts["runway"] = rng.randint(1, 36)
+            facts["registration"] = "HB-" + ''.join(rng.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ', k=3))
+            event["details"] = (f"{facts['registration']} {rng.choice(aircraft)}"
+                                f"FlugzeugBetriebsart: {rng.choice(operations)}")
+        else:
+            facts["wagon"] = rng.randint(1, 40)
+            event["type"] = rng.choice(train_types)
+        event["content"] = [{"lang": language, "content": event_content(language, facts, rng)}
+                            for language in languages + ['en']]
+        event["facts"] = facts
+        events.append(event)
+    return events
+
+
+def stsb_mentions(event: dict, kind: str, language: str, rng: random.Random):
+    facts = event["facts"]
+    day, month, year = event["event_date"].split('.')
+    mentions = [f"{day}{rng.choice(['', '.'])} {month_names[language][int(month) - 1]} {year}"]
+    if rng.random() < 0.8:
+        mentions.append(facts["place"])
+    if kind == 'aviation' and rng.random() < 0.7:
+        mentions.append(facts["registration"])
+    if rng.random() < 0.5:
+        mentions.append(facts["time"])
+    if rng.random() < 0.4:
+        mentions.append(f"{report_titles['de' if language == 'de' else 'fr']} {facts['report_number']}")
+    if kind == 'aviation' and rng.random() < 0.3:
+        mentions.append(f" Piste {facts['runway']}")
+    if kind == 'trains_and_ships' and rng.random() < 0.3:
+        mentions.append(f" wagen {facts['wagon']}" if language == 'de' else f" wagon n° {facts['wagon']}")
+    return mentions
+
+
+def generate_stsb(out_dir: Path, num_decisions: int, num_events: int, words: int = 1000, seed: int = 0):
+    rng = random.Random(seed)
+    data_dir = out_dir / 'data'
+    data_dir.mkdir(parents=True, exist_ok=True)
+    events = {"aviation": generate_events(num_events, 'aviation', rng),
+              "trains_and_ships": generate_events(max(num_events // 2, 1), 'trains_and_ships', rng)}
+    for kind, file in (("aviation", 'aviatik.json'), ("trains_and_ships", 'bahnen_und_schiffe.json')):
+        with open(data_dir / file, 'w') as f:
+            json.dump([{key: value for key, value in event.items() if key != "facts"} for event in events[kind]], f)
+
+    rows = []
+    for file_id in range(num_decisions):
+        language = rng.choice(languages)
+        mentions = [rng.choice(['SUST', 'STSB', 'SISI', 'SESE'])]
+        draw = rng.random()
+        if draw < 0.85:  # the others do not mention any event
+            kind = "aviation" if draw < 0.6 else "trains_and_ships"
+            mentions += stsb_mentions(rng.choice(events[kind]), kind, language, rng)
+        text = embed(filler(language, words, rng), mentions, rng)
+        canton, court = rng.choice(courts)
+        rows.append({
+            "file_id": file_id, "language": language, "canton_name": canton, "court_name": court,
+            "chamber_string": f"{court}_{rng.randint(1, 6)}",
+            "date": f"{rng.randint(2000, 2021)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "pdf_url": f"https://example.org/stsb/{file_id}.pdf", "html_url": f"https://example.org/stsb/{file_id}.html",
+            "pdf_raw": text,
+            # about half of the decisions also have an html body with the same text
+            "html_raw": f"<p>{text}</p>" if rng.random() < 0.5 else None,
+        })
+    pd.DataFrame(rows).to_csv(data_dir / 'decisions.csv', index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic input data for the SIMAP and STSB pipelines")
+    parser.add_argument('out_dir', type=Path, help="directory in which the data folder is created")
+    parser.add_argument('--pipeline', choices=['simap', 'stsb'], required=True)
+    parser.add_argument('--decisions', type=int, default=1000, help="number of decisions")
+    parser.add_argument('--references', type=int, default=None,
+                        help="number of SIMAP projects or STSB aviation events (half as many train and ship events), "
+                             "by default as many as decisions")
+    parser.add_argument('--words', type=int, default=1000, help="number of filler words per decision text")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate = generate_simap if args.pipeline == 'simap' else generate_stsb
+    generate(args.out_dir, args.decisions, args.references or args.decisions, args.words, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+Timed runs of the SIMAP and STSB pipeline stages on synthetic data (see generate_data.py) at several scales.
+
+Every scale gets its own working directory with a data folder, the pipelines are run from there just like from
+their own folders. The timings are appended to a JSON lines file, one record per pipeline, scale and stage, and are
+compared with the last recorded run of the same stage and scale, so scaling regressions show up as the corpus grows.
+
+    python benchmarks/run_benchmarks.py --scales 1000 5000 --pipelines simap stsb
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from generate_data import generate_simap, generate_stsb
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def load_pipeline(pipeline: str):
+    # both pipelines are scripts called re_identification.py, so they are loaded by path under their own names
+    spec = importlib.util.spec_from_file_location(f'{pipeline}_re_identification',
+                                                  REPO_DIR / pipeline / 're_identification.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Timer:
+    """Collects the wall time of the stages of one run"""
+
+    def __init__(self, pipeline: str, scale: int, quiet: bool = True):
+        self.pipeline = pipeline
+        self.scale = scale
+        self.quiet = quiet
+        self.records = []
+
+    def run(self, stage: str, func, *args, rows: int = None, **kwargs):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output) if self.quiet else contextlib.nullcontext():
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except (ImportError, LookupError, OSError) as error:
+                # e.g. spaCy models or NLTK data that are not installed
+                self.records.append({"pipeline": self.pipeline, "scale": self.scale, "stage": stage,
+                                     "skipped": f"{type(error).__name__}: {error}"})
+                return None
+            seconds = time.perf_counter() - start
+        self.records.append({"pipeline": self.pipeline, "scale": self.scale, "stage": stage,
+                             "seconds": round(seconds, 4), "rows": rows})
+        return result
+
+
+def bench_simap(work_dir: Path, scale: int, words: int, seed: int):
+    generate_simap(work_dir, scale, scale, words, seed)
+    (work_dir / 'results').mkdir(exist_ok=True)
+    simap = load_pipeline('simap')
+    timer = Timer('simap', scale)
+
+    timer.run('prepare_awards', simap.prepare_awards)
+    timer.run('load_awards (cold cache)', simap.load_awards)
+    timer.run('load_awards (warm cache)', simap.load_awards)
+    decisions = timer.run('read_decisions', lambda: pd.concat(simap.read_decisions()))
+    rows = len(decisions.index)
+    timer.run('get_identifiers', lambda: [
+        (simap.get_identifiers(text, language, 'projectID'), simap.get_identifiers(text, language, 'noticeNumber'))
+        for text, language in zip(decisions.text, decisions.language)], rows=rows)
+    timer.run('extract_identifiers', simap.extract_identifiers, decisions, rows=rows)
+    linked = timer.run('link_decisions', simap.link_decisions, decisions, rows=rows)
+    non_re_identified, re_identified = timer.run('split_re_identified', simap.split_re_identified, linked, rows=rows)
+    timer.run('make_reports', simap.make_reports, re_identified, linked, ['canton', 'court', 'year'], 'csv', 'none',
+              rows=rows)
+    return timer.records
+
+
+def bench_stsb(work_dir: Path, scale: int, words: int, seed: int):
+    generate_stsb(work_dir, scale, scale, words, seed)
+    stsb = load_pipeline('stsb')
+    timer = Timer('stsb', scale)
+
+    timer.run('load_events (cold cache)', stsb.load_events)
+    if stsb.aviation is None:  # NLTK data is missing, nothing else can run
+        return timer.records
+    timer.run('load_events (warm cache)', stsb.load_events)
+    decisions = timer.run('prepare_decisions', lambda: pd.concat(stsb.prepare_decisions()))
+    rows = len(decisions.index)
+    # the scoring of link_decisions per event table, with the scorers built as part of it
+    stsb.scorers.clear()
+    for name in ('aviation', 'trains_and_ships'):
+        timer.run(f'link_to_events ({name})', stsb.link_to_events, name, decisions.text.tolist(),
+                  decisions.language.tolist(), rows=rows)
+    stsb.scorers.clear()  # the scorers are built as part of the linking
+    linked_to_aviation, linked_to_train = timer.run('link_decisions', stsb.link_decisions, decisions, rows=rows)
+    linked = len(linked_to_aviation.index) + len(linked_to_train.index)
+    timer.run('ner (cold cache)', lambda: (stsb.ner(linked_to_aviation, stsb.aviation, "aviation"),
+                                           stsb.ner(linked_to_train, stsb.trains_and_ships, "trains_and_ships")),
+              rows=linked)
+    timer.run('ner (warm cache)', lambda: (stsb.ner(linked_to_aviation, stsb.aviation, "aviation"),
+                                           stsb.ner(linked_to_train, stsb.trains_and_ships, "trains_and_ships")),
+              rows=linked)
+    return timer.records
+
+
+benchmarks = {'simap': bench_simap, 'stsb': bench_stsb}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_seconds(results_file: Path):
+    # the last recorded timing per pipeline, scale and stage
+    previous = {}
+    if results_file.exists():
+        with open(results_file) as f:
+            for line in f:
+                record = json.loads(line)
+                if 'seconds' in record:
+                    previous[(record['pipeline'], record['scale'], record['stage'])] = record['seconds']
+    return previous
+
+
+def print_records(records, previous):
+    for record in records:
+        name = f"{record['pipeline']:6} {record['scale']:>8} {record['stage']:34}"
+        if 'skipped' in record:
+            print(f"{name} skipped ({record['skipped']})")
+            continue
+        line = f"{name} {record['seconds']:10.3f}s"
+        if record['rows']:
+            line += f" {1000 * record['seconds'] / record['rows']:10.3f}s per 1000 rows"
+        last = previous.get((record['pipeline'], record['scale'], record['stage']))
+        if last:
+            line += f" {record['seconds'] / last:6.2f}x the last run"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the SIMAP and STSB pipeline stages on synthetic data")
+    parser.add_argument('--pipelines', nargs='*', default=list(benchmarks), choices=list(benchmarks))
+    parser.add_argument('--scales', nargs='*', type=int, default=[1000, 5000],
+                        help="numbers of decisions, with as many SIMAP projects and STSB aviation events")
+    parser.add_argument('--words', type=int, default=1000, help="number of filler words per decision text")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', type=Path, default=REPO_DIR / 'benchmarks' / 'work',
+                        help="the generated data and caches are kept here, one folder per pipeline and scale")
+    parser.add_argument('--results', type=Path, default=REPO_DIR / 'benchmarks' / 'work' / 'results.jsonl',
+                        help="JSON lines file the timings are appended to")
+    args = parser.parse_args()
+
+    previous = previous_seconds(args.results)
+    run = {"commit": git_commit(), "date": time.strftime('%Y-%m-%dT%H:%M:%S'), "python": platform.python_version(),
+           "pandas": pd.__version__, "machine": platform.machine(), "cpus": os.cpu_count(), "words": args.words}
+    cwd = os.getcwd()
+    for pipeline in args.pipelines:
+        for scale in args.scales:
+            work_dir = (args.work_dir / f"{pipeline}-{scale}-{args.words}-{args.seed}").resolve()
+            for cache in ('cache', 'ner_cache'):  # every run starts with cold caches
+                for cached in (work_dir / cache).glob('*'):
+                    cached.unlink()
+            work_dir.mkdir(parents=True, exist_ok=True)
+            os.chdir(work_dir)
+            try:
+                records = benchmarks[pipeline](work_dir, scale, args.words, args.seed)
+            finally:
+                os.chdir(cwd)
+            print_records(records, previous)
+            args.results.parent.mkdir(parents=True, exist_ok=True)
+            with open(args.results, 'a') as f:
+                for record in records:
+                    f.write(json.dumps({**run, **record}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+Long-running re-identification service for single decisions.
+
+The awards and both STSB event tables are loaded and indexed once at start-up (and the spaCy models with --preload),
+then every request is answered from memory: the SIMAP projectIDs and noticeNumbers with the linked awards, and the
+linked STSB event with the entities of its content. Requests are JSON objects with the decision text and language,
+optionally its html body and an id that is returned with the response:
+
+    {"id": "1", "language": "de", "text": "... Projekt-ID 12345 ..."}
+
+By default requests are read as JSON lines from stdin and answered as JSON lines on stdout, with --port the same
+objects are posted to http://localhost:<port>/reidentify. Both pipelines read their data, caches and NER cache from
+their own folders (simap/ and stsb/), like when they are run from there.
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import math
+import sys
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def load_pipeline(pipeline: str, folder: Path):
+    # both pipelines are scripts called re_identification.py, so they are loaded by path under their own names
+    spec = importlib.util.spec_from_file_location(f'{pipeline}_re_identification',
+                                                  REPO_DIR / pipeline / 're_identification.py')
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    module.DATA_DIR = folder / 'data'
+    module.CACHE_DIR = folder / 'cache'
+    if hasattr(module, 'NER_CACHE_DIR'):
+        module.NER_CACHE_DIR = folder / 'ner_cache'
+    return module
+
+
+def plain(value):
+    # JSON compatible values: numpy scalars as Python numbers, NaN (e.g. unknown award prices) and NA as null
+    if value is pd.NA:
+        return None
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [plain(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+class ReIdentificationService:
+    """Holds both pipelines with their reference data loaded and answers one decision at a time"""
+
+    def __init__(self, simap_dir: Path = None, stsb_dir: Path = None, preload: bool = False):
+        self.simap = self.stsb = None
+        # the pipelines report what they load on stdout, which is reserved for the responses
+        with contextlib.redirect_stdout(sys.stderr):
+            if simap_dir is not None:
+                self.simap = load_pipeline('simap', simap_dir)
+                self.simap.load_awards()
+            if stsb_dir is not None:
+                self.stsb = load_pipeline('stsb', stsb_dir)
+                self.stsb.load_events()
+                self.stsb.build_indexes()
+                if preload:
+                    for language in self.stsb.nlp_model_names:
+                        self.stsb.load_nlp(language)
+
+    def link_simap(self, text: str, language: str):
+        decision = pd.DataFrame({"language": [language], "pdf_url": [None], "html_url": [None], "text": [text]})
+        decision['text'] = self.simap.normalize_texts(decision.text)
+        linked = self.simap.link_decisions(decision).iloc[0]
+        response = {column: plain(linked[column]) for column in ['projectIDs', 'noticeNumbers', 'linked_projectID',
+                                                                 'linked_noticeNumber']}
+        # the linked decisions only keep the linked identifiers, the awards of a single decision are looked up
+        for query, index in (('projectID', self.simap.awards_by_projectID),
+                             ('noticeNumber', self.simap.awards_by_noticeNumber)):
+            identifier = response[f'linked_{query}']
+            response[f'awards_found_by_{query}'] = plain(index.find(identifier)) if identifier is not None else None
+        return response
+
+    def link_stsb(self, text: str, html: str, language: str):
+        decision = pd.DataFrame({"file_id": [0], "language": [language], "text": [text]})
+        if self.stsb.NORMALIZE_TEXT:
+            decision['text'] = self.stsb.normalize_text(pd.Series([text]), pd.Series([html]))
+        elif html:
+            decision['text'] = text + html
+        linked_to_aviation, linked_to_train = self.stsb.link_decisions(decision)
+        for name, events, linked in (("aviation", self.stsb.aviation, linked_to_aviation),
+                                     ("trains_and_ships", self.stsb.trains_and_ships, linked_to_train)):
+            if len(linked.index):
+                linked = self.stsb.ner(linked, events, name).iloc[0]
+                return {"linked_to": name, "event_id": plain(linked.event_id), "entities": plain(linked.entities)}
+        return {"linked_to": None, "event_id": None, "entities": None}
+
+    def handle(self, request: dict):
+        start = time.perf_counter()
+        response = {"id": request.get("id") if isinstance(request, dict) else None}
+        try:
+            text, language = request["text"], request["language"]
+            if self.simap is not None:
+                if language in self.simap.search_queries:
+                    response["simap"] = self.link_simap(text, language)
+                else:
+                    response["simap"] = None
+            if self.stsb is not None:
+                if language in self.stsb.dic:
+                    response["stsb"] = self.link_stsb(text, request.get("html"), language)
+                else:
+                    response["stsb"] = None
+        except Exception as error:  # one failing request must not stop the service
+            response["error"] = f"{type(error).__name__}: {error}"
+            if not isinstance(error, (KeyError, TypeError, ValueError)):  # not a malformed request
+                traceback.print_exc(file=sys.stderr)
+        response["latency_ms"] = round(1000 * (time.perf_counter() - start), 2)
+        return response
+
+
+def serve_json_lines(service: ReIdentificationService):
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            response = service.handle(json.loads(line))
+        except json.JSONDecodeError as error:
+            response = {"error": f"JSONDecodeError: {error}"}
+        print(json.dumps(response, ensure_ascii=False), flush=True)
+
+
+def serve_http(service: ReIdentificationService, port: int):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status: int, body: dict):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, {"simap": service.simap is not None, "stsb": service.stsb is not None})
+            else:
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != '/reidentify':
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except json.JSONDecodeError as error:
+                self.send_json(400, {"error": f"JSONDecodeError: {error}"})
+                return
+            response = service.handle(request)
+            self.send_json(400 if "error" in response else 200, response)
+
+    # requests are answered one after the other, the pipelines keep their indexes in module globals
+    server = HTTPServer(('localhost', port), Handler)
+    print(f"Serving on http://localhost:{port}/reidentify", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-identify single decisions with SIMAP awards and STSB events")
+    parser.add_argument('--port', type=int, default=None,
+                        help="serve HTTP on this port instead of JSON lines on stdin/stdout")
+    parser.add_argument('--simap-dir', type=Path, default=REPO_DIR / 'simap',
+                        help="folder with the data and cache folders of the SIMAP pipeline")
+    parser.add_argument('--stsb-dir', type=Path, default=REPO_DIR / 'stsb',
+                        help="folder with the data, cache and ner_cache folders of the STSB pipeline")
+    parser.add_argument('--pipelines', nargs='*', default=['simap', 'stsb'], choices=['simap', 'stsb'])
+    parser.add_argument('--preload', action='store_true',
+                        help="load the spaCy models at start-up instead of on the first decision that needs them")
+    args = parser.parse_args()
+
+    service = ReIdentificationService(args.simap_dir if 'simap' in args.pipelines else None,
+                                      args.stsb_dir if 'stsb' in args.pipelines else None, args.preload)
+    if args.port is None:
+        serve_json_lines(service)
+    else:
+        serve_http(service, args.port)
+
+
+if __name__ == '__main__':
+    main()
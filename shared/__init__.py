@@ -0,0 +1,5 @@
+"""
+Code shared by the SIMAP and STSB pipelines: the parquet cache of the prepared reference data, the stage profiler,
+the result writers, the SQLite result store and the shard assignment. Both pipelines are scripts run from their own folders, they put the repository folder on sys.path
+to import this package.
+"""
@@ -0,0 +1,24 @@
+from pathlib import Path
+
+import pandas as pd
+
+
+def cached_parquet(source: Path, cache_dir: Path, version: int, prepare):
+    """
+    The table prepare() builds from the source file, cached as a parquet file in cache_dir and read memory-mapped on
+    later runs. The cache file name contains the modification time and size of the source, so a changed source is
+    prepared again, and the version of the preparation, which is raised whenever the preparation itself changes.
+    """
+    stat = source.stat()
+    cache_file = cache_dir / f"{source.stem}-{stat.st_mtime_ns}-{stat.st_size}-v{version}.parquet"
+    if cache_file.exists():
+        return pd.read_parquet(cache_file, memory_map=True)
+    df = prepare()
+    cache_dir.mkdir(exist_ok=True)
+    for outdated in cache_dir.glob(f"{source.stem}-*.parquet"):
+        outdated.unlink()
+    # written under a temporary name first, so an interrupted run does not leave a truncated cache file
+    partial_file = cache_file.with_suffix('.partial')
+    df.to_parquet(partial_file)
+    partial_file.replace(cache_file)
+    return df
@@ -0,0 +1,79 @@
+import contextlib
+import cProfile
+import json
+import pstats
+import sys
+import time
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # not available on Windows, the peak RSS is not recorded there
+    resource = None
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)  # bytes on macOS, KiB on Linux
+
+
+class StageProfiler:
+    """
+    Records wall time, CPU time, peak RSS and row counts per stage of a run. A stage that runs once per batch is
+    summed up over its calls and stages can be nested (e.g. reading a source file inside loading the reference data).
+    The peak RSS is the peak of the whole process at the end of the stage, so the stage where it grows is the one that
+    needs the memory. One stage can additionally be run under cProfile.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.cprofile_stage = None
+        self.cprofile = cProfile.Profile()
+        self.started = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, rows: int = None):
+        # the caller can set the rows of the stage in the yielded dict once it knows them
+        counts = {"rows": rows}
+        profiled = name == self.cprofile_stage
+        if profiled:
+            self.cprofile.enable()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield counts
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            if profiled:
+                self.cprofile.disable()
+            record = self.stages.setdefault(name, {"stage": name, "calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "rows": None})
+            record["calls"] += 1
+            record["wall_s"] += wall
+            record["cpu_s"] += cpu
+            if counts["rows"] is not None:
+                record["rows"] = (record["rows"] or 0) + counts["rows"]
+            record["peak_rss_mb"] = peak_rss_mb()
+
+    def batches(self, name: str, batches):
+        # times reading each batch of an iterator and counts its rows
+        batches = iter(batches)
+        while True:
+            with self.stage(name) as stage:
+                batch = next(batches, None)
+                stage["rows"] = len(batch.index) if batch is not None else None
+            if batch is None:
+                return
+            yield batch
+
+    def write(self, path: Path, **run):
+        profile = {**run, "started": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                   "wall_s": round(time.time() - self.started, 3), "peak_rss_mb": peak_rss_mb(),
+                   "stages": [{key: round(value, 3) if isinstance(value, float) else value for key, value in record.items()}
+                              for record in self.stages.values()]}
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(profile, f, indent=2)
+        if self.cprofile_stage is not None:
+            self.cprofile.dump_stats(path.with_suffix(f'.{self.cprofile_stage}.prof'))
+            pstats.Stats(self.cprofile).sort_stats('cumulative').print_stats(25)
@@ -0,0 +1,24 @@
+"""
+Sharded runs: with --shard INDEX/COUNT a worker only processes the decisions whose key hashes to its shard and writes
+its partial results. The hash does not depend on the machine or the Python process, so a failed shard can be rerun on
+its own. --merge COUNT reads the partial results of all shards, restores the order of a single-node run and writes the
+same results.
+"""
+import argparse
+import hashlib
+
+import numpy as np
+
+
+def parse_shard(spec: str):
+    # --shard INDEX/COUNT
+    index, count = (int(part) for part in spec.split('/'))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"the shard index must be between 0 and {count - 1}, got {spec}")
+    return index, count
+
+
+def shard_of(keys, count: int):
+    # the shard of every decision key, a hash that does not depend on the machine or the Python process
+    return np.array([int(hashlib.sha1(str(key).encode('utf-8')).hexdigest()[:8], 16) % count for key in keys],
+                    dtype=int)
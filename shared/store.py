@@ -0,0 +1,56 @@
+import hashlib
+import json
+import sqlite3
+
+from shared.writers import json_default
+
+
+def text_hash(text):
+    return hashlib.sha1(str(text).encode('utf-8')).hexdigest()
+
+
+def file_hash(*paths, settings=()):
+    # hash of the contents of the reference data files and the settings the results depend on, stored results are
+    # only reused for the same data
+    version = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                version.update(block)
+    for setting in settings:
+        version.update(str(setting).encode())
+    return version.hexdigest()
+
+
+class ResultStore:
+    """
+    Results of earlier runs per decision, stored in SQLite with the hash of the decision text and the version of the
+    reference data they were computed with. The pipelines decide which stored results they can reuse.
+    """
+
+    def __init__(self, path, data_version: str, key_column: str = 'key'):
+        # key_column is the name of the key column of existing stores (the STSB store is keyed by file_id)
+        self.connection = sqlite3.connect(path)
+        self.key_column = key_column
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS results "
+                                f"({key_column} TEXT PRIMARY KEY, text_hash TEXT, data_version TEXT, result TEXT)")
+        self.data_version = data_version
+
+    def get(self, keys):
+        # key -> (text_hash, data_version, result)
+        found = {}
+        for start in range(0, len(keys), 500):  # stay below the sqlite limit of query parameters
+            batch = keys[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT {self.key_column}, text_hash, data_version, result FROM results "
+                f"WHERE {self.key_column} IN ({','.join('?' * len(batch))})", batch)
+            for key, hash_, data_version, result in rows:
+                found[key] = (hash_, data_version, json.loads(result))
+        return found
+
+    def put(self, rows):
+        # rows of (key, text_hash, result)
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+            [(key, hash_, self.data_version, json.dumps(result, default=json_default)) for key, hash_, result in rows])
+        self.connection.commit()
@@ -0,0 +1,106 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas import DataFrame
+
+
+class CsvWriter:
+    """Appends batches of results to one CSV file, the header is only written with the first batch"""
+
+    def __init__(self, path: Path):
+        self.path = path.with_suffix('.csv')
+        self.header = True
+
+    def write(self, df: DataFrame):
+        df.to_csv(self.path, mode='w' if self.header else 'a', header=self.header)
+        self.header = False
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def read(path: Path):
+        return pd.read_csv(path.with_suffix('.csv'), index_col=0)
+
+
+class JsonLinesWriter:
+    """Appends batches of results to a JSON lines file, one record per row including its index"""
+
+    def __init__(self, path: Path):
+        self.path = path.with_suffix('.jsonl')
+        self.file = open(self.path, 'w')
+
+    def write(self, df: DataFrame):
+        lines = df.reset_index().to_json(orient='records', lines=True, date_format='iso', default_handler=str)
+        if lines and not lines.endswith('\n'):
+            lines += '\n'
+        self.file.write(lines)
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def read(path: Path):
+        return pd.read_json(path.with_suffix('.jsonl'), lines=True).set_index('index')
+
+
+def json_default(value):
+    # numpy scalars (e.g. extracted identifiers) as numbers, anything else as text
+    return value.item() if isinstance(value, np.generic) else str(value)
+
+
+class ParquetWriter:
+    """Appends batches of results as row groups to one parquet file, nested values are stored as JSON strings"""
+
+    def __init__(self, path: Path):
+        self.path = path.with_suffix('.parquet')
+        self.writer = None
+        self.empty = None
+
+    @staticmethod
+    def encode(df: DataFrame):
+        df = df.copy()
+        if isinstance(df.columns, pd.MultiIndex):  # e.g. the SIMAP bidder aggregates
+            df.columns = [' '.join(level for level in column if level) for column in df.columns]
+        if df.index.inferred_type == 'mixed-integer':  # e.g. the years of the SIMAP year summary and 'all'
+            df.index = df.index.astype(str)
+        for column in df.columns[df.dtypes == object]:
+            df[column] = [json.dumps(value, default=json_default) if isinstance(value, (list, dict)) else value
+                          for value in df[column]]
+        return df.infer_objects()
+
+    def write(self, df: DataFrame):
+        df = self.encode(df)
+        if self.writer is None and not len(df.index):
+            # the schema is taken from the first batch with rows, an empty file only if all batches are empty
+            self.empty = df
+            return
+        if self.writer is None:
+            # columns of Python objects (or only missing values) in the first batch are strings for all batches,
+            # typed columns keep their type even if all their values are missing
+            schema = pa.Schema.from_pandas(df, preserve_index=True)
+            untyped = {str(column) for column in df.columns if df[column].dtype == object}
+            schema = pa.schema([pa.field(field.name, pa.string()) if field.name in untyped else field
+                                for field in schema], metadata=schema.metadata)
+            self.writer = pq.ParquetWriter(self.path, schema)
+        for field in self.writer.schema:
+            if field.type == pa.string() and field.name in df.columns:
+                df[field.name] = df[field.name].where(df[field.name].isna(), df[field.name].astype(str))
+        self.writer.write_table(pa.Table.from_pandas(df, schema=self.writer.schema, preserve_index=True))
+
+    def close(self):
+        if self.writer is None and self.empty is not None:
+            pq.write_table(pa.Table.from_pandas(self.empty, preserve_index=True), self.path)
+        if self.writer is not None:
+            self.writer.close()
+
+    @staticmethod
+    def read(path: Path):
+        return pd.read_parquet(path.with_suffix('.parquet'))
+
+
+result_writers = {'csv': CsvWriter, 'jsonl': JsonLinesWriter, 'parquet': ParquetWriter}
@@ -1,20 +1,35 @@
+import argparse
+import functools
+import html
 import json
 import random
 import re
+import sys
 from pathlib import Path
 from pprint import pprint
 
+import ijson
 import numpy as np
 import pandas as pd
 from pandas import DataFrame
 
-import plotly.express as px
 
 pd.set_option('display.max_columns', None)  # or 1000
 pd.set_option('display.max_rows', None)  # or 1000
 pd.set_option('display.max_colwidth', None)  # or 199
 
+# the modules shared with the STSB pipeline are in the shared folder of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from shared.cache import cached_parquet
+from shared.profiling import StageProfiler
+from shared.sharding import parse_shard, shard_of
+from shared.store import ResultStore, file_hash, text_hash
+from shared.writers import ParquetWriter, result_writers
+
 DATA_DIR = Path('data')
+CACHE_DIR = Path('cache')
+
+profiler = StageProfiler()
 
 search_queries = {
     "de": {"projectID": r"projekt.?id|simap.?nr\.?| -id",
@@ -41,11 +56,26 @@ it: 46
 """
 
 
-def prepare_awards():
-    awards_file = DATA_DIR / 'intelliprocure_all_awards.json'
-    with open(awards_file, 'r') as f:
-        data = json.load(f)[2]['data']
-    df = pd.DataFrame(data)
+# the columns of the awards used for linking and reporting
+award_columns = ['projectID', 'noticeNumber', 'price', 'bidder', 'contractor', 'projectTitle', 'datePublication']
+
+
+def awards_path():
+    return DATA_DIR / 'intelliprocure_all_awards.json'
+
+
+def export_data(events):
+    # only pass on the parse events of the third element of the export, which holds the data array
+    element = -1
+    for prefix, event, value in events:
+        if prefix == 'item' and event in ('start_map', 'start_array'):
+            element += 1
+        if element == 2 or prefix == '':
+            yield prefix, event, value
+
+
+def typed_awards(rows):
+    df = pd.DataFrame(rows, columns=award_columns)
     df.projectID = df.projectID.astype(int)
     df.noticeNumber = df.noticeNumber.astype(int)
     df.price = df.price.astype(float)  # cannot convert to int because of NA and inf
@@ -54,29 +84,53 @@ def prepare_awards():
     return df
 
 
-awards = prepare_awards()
-print(f"Our database of awards contains {len(awards.index)} entries")
-print(f"The median awarded price is {int(awards.price.median())}")
-print(f"There are {len(awards.bidder.unique())} unique bidders")
-print(f"There are {len(awards.contractor.unique())} unique contractors")
+def prepare_awards(chunksize: int = 100000):
+    # The export is parsed as a stream and only the award_columns are kept. They are converted to typed columns
+    # every chunksize awards, so the whole export is never held as Python objects.
+    with profiler.stage('prepare_awards') as stage:
+        chunks, rows = [], []
+        with open(awards_path(), 'rb') as f:
+            for award in ijson.items(export_data(ijson.parse(f, use_float=True)), 'item.data.item'):
+                rows.append([award.get(column) for column in award_columns])
+                if len(rows) == chunksize:
+                    chunks.append(typed_awards(rows))
+                    rows = []
+        chunks.append(typed_awards(rows))
+        awards = pd.concat(chunks, ignore_index=True)
+        stage["rows"] = len(awards.index)
+    return awards
+
 
+# raised whenever prepare_awards changes, so awards prepared by an older version are not read from the cache
+PREPARE_VERSION = 1
 
-def prepare_decisions(language: str):
+
+def cached_awards():
+    # the prepared awards are read memory-mapped from the cache unless the export or PREPARE_VERSION changed
+    return cached_parquet(awards_path(), CACHE_DIR, PREPARE_VERSION, prepare_awards)
+
+
+def prepare_decisions(language: str, chunksize: int = None):
+    # with a chunksize, this returns an iterator over batches of chunksize decisions instead of one DataFrame
     decisions_file = DATA_DIR / f'{language}_simap.csv'
     interesting_cols = ['language', 'canton', 'court', 'chamber', 'date', 'pdf_url', 'html_url', 'text']
-    return pd.read_csv(decisions_file, usecols=interesting_cols)
+    return pd.read_csv(decisions_file, usecols=interesting_cols, chunksize=chunksize)
+
+
+def normalize_texts(texts: pd.Series):
+    # Done once per decision when it is read: unescape html entities, collapse whitespace and lowercase, so the
+    # identifier patterns (which are all lowercase) run without re.IGNORECASE. Line breaks are kept, the .*? between
+    # a query and its number stops at the end of the line like on the raw text.
+    texts = texts.map(html.unescape, na_action='ignore')
+    return texts.str.replace(r'[^\S\n]+', ' ', regex=True).str.strip().str.lower()
 
 
-lang_decisions = []
-for language in search_queries.keys():
-    lang_decisions.append(prepare_decisions(language))
-decisions = pd.concat(lang_decisions)
-num_decisions = len(decisions.index)
-terms = []
-for queries in search_queries.values():
-    terms.append(queries['projectID'])
-    terms.append(queries['noticeNumber'])
-print(f"Found {num_decisions} decisions containing at least one of the following terms {terms}")
+def read_decisions(chunksize: int = None):
+    for language in search_queries.keys():
+        lang_decisions = prepare_decisions(language, chunksize)
+        for batch in [lang_decisions] if chunksize is None else lang_decisions:
+            batch['text'] = normalize_texts(batch.text)
+            yield batch
 
 
 def get_identifiers(decision, language, query):
@@ -84,13 +138,30 @@ def get_identifiers(decision, language, query):
     return list(set([int(match[1]) for match in re.findall(regex, decision, re.IGNORECASE)]))
 
 
-# Get the actual projectIDs and noticeNumbers from the text
-decisions['projectIDs'] = decisions.apply(
-    lambda decision: get_identifiers(decision.text, decision.language, "projectID"), axis=1)
-decisions['noticeNumbers'] = decisions.apply(
-    lambda decision: get_identifiers(decision.text, decision.language, "noticeNumber"), axis=1)
-
-decisions = decisions.drop(columns=["text"])  # drop text so we can look at the df more easily
+def identifier_pattern(language: str):
+    # One pattern per language with a named group per query. The lookaheads do not consume any text, so overlapping
+    # matches of the two queries are all found, just like in two separate get_identifiers scans.
+    queries = search_queries[language]
+    return (rf"(?={queries['projectID']}|{queries['noticeNumber']})"
+            rf"(?:(?=(?:{queries['projectID']}).*?(?P<projectID>\d+)))?"
+            rf"(?:(?=(?:{queries['noticeNumber']}).*?(?P<noticeNumber>\d+)))?")
+
+
+def extract_identifiers(decisions: DataFrame):
+    # vectorized version of get_identifiers: one str.extractall pass over the (normalized) texts of each language
+    found = {"projectID": [[] for _ in range(len(decisions.index))],
+             "noticeNumber": [[] for _ in range(len(decisions.index))]}
+    for language in search_queries.keys():
+        positions = np.flatnonzero(decisions.language.to_numpy() == language)
+        if not len(positions):
+            continue
+        texts = decisions.text.iloc[positions].reset_index(drop=True)
+        matches = texts.str.extractall(identifier_pattern(language))
+        for query in found.keys():
+            numbers = matches[query].dropna().map(int)  # Python ints, a long run of digits does not fit into int64
+            for row, identifiers in numbers.groupby(level=0):
+                found[query][positions[row]] = list(set(identifiers))
+    return found["projectID"], found["noticeNumber"]
 
 
 def clean_awarded_df(awarded):
@@ -107,73 +178,358 @@ def clean_awarded_df(awarded):
     # return awarded[columns].to_json()
 
 
-def find_by_projectID(projectID: int):
-    return clean_awarded_df(awards[awards.projectID == projectID])
-
+class AwardIndex:
+    """
+    Awards grouped once by an identifier column, so linking is a lookup instead of a scan over all awards. The groups
+    are stored columnar: the award rows of group g are rows[offsets[g]:offsets[g + 1]], in the order of the export.
+    """
+
+    def __init__(self, awards: DataFrame, column: str):
+        self.awards = awards
+        values = awards[column].to_numpy()
+        self.rows = np.argsort(values, kind='stable')
+        self.identifiers, starts = np.unique(values[self.rows], return_index=True)
+        self.offsets = np.append(starts, len(self.rows))
+        self.found = {}  # cleaned awards per identifier, only built for identifiers we actually look up
+
+    def groups(self, identifiers):
+        # the group of every identifier, -1 for missing identifiers and identifiers not in the export
+        # (identifiers outside of int64, e.g. a long run of digits after a query term, cannot be in the export)
+        limits = np.iinfo(np.int64)
+        identifiers = pd.array([identifier if identifier is not None and identifier is not pd.NA
+                                and limits.min <= identifier <= limits.max else None for identifier in identifiers],
+                               dtype='Int64')
+        values = identifiers.to_numpy(dtype=np.int64, na_value=0)
+        groups = np.searchsorted(self.identifiers, values)
+        found = ~identifiers.isna() & (groups < len(self.identifiers))
+        found[found] = self.identifiers[groups[found]] == values[found]
+        return np.where(found, groups, -1)
+
+    def find(self, identifier: int):
+        if identifier not in self.found:
+            group = self.groups([identifier])[0]
+            self.found[identifier] = None if group < 0 else clean_awarded_df(
+                self.awards.iloc[self.rows[self.offsets[group]:self.offsets[group + 1]]])
+        return self.found[identifier]
+
+    def find_first(self, identifier_lists):
+        # per decision, the first extracted identifier that is found in the IntelliProcure export (or None)
+        flat = [identifier for identifiers in identifier_lists for identifier in identifiers]
+        decisions = np.repeat(np.arange(len(identifier_lists)), [len(identifiers) for identifiers in identifier_lists])
+        found = np.flatnonzero(self.groups(flat) >= 0)
+        linked, first = np.unique(decisions[found], return_index=True)
+        first_found = [None] * len(identifier_lists)
+        for decision, position in zip(linked, found[first]):
+            first_found[decision] = flat[position]
+        return first_found
+
+    @functools.cached_property
+    def group_summaries(self):
+        # per group: the mean price and (like clean_awarded_df) the first bidder and contractor and the projectTitle
+        starts, counts = self.offsets[:-1], np.diff(self.offsets)
+        first = self.rows[starts]
+        prices = self.awards.price.to_numpy(dtype=float)[self.rows]
+        groups = np.repeat(np.arange(len(starts)), counts)
+        return pd.DataFrame({
+            'mean_price': np.bincount(groups, weights=prices, minlength=len(starts)) / counts,
+            'bidder': self.awards.bidder.to_numpy()[first],
+            'contractor': self.awards.contractor.to_numpy()[first],
+            'projectTitle': self.awards.projectTitle.to_numpy()[first],
+            'projectTitles': pd.Series(self.awards.projectTitle.to_numpy()[self.rows]).groupby(groups).nunique(
+                dropna=False).to_numpy(),
+        })
+
+    def summaries(self, identifiers):
+        # the group summaries of the linked identifiers, gathered by group, NaN where nothing is linked
+        summaries = self.group_summaries.reindex(self.groups(identifiers))
+        assert (summaries.projectTitles.dropna() == 1).all()  # there should only be one projectTitle
+        return summaries.drop(columns='projectTitles').reset_index(drop=True)
+
+
+awards = None
+awards_by_projectID = None
+awards_by_noticeNumber = None
+
+
+def load_awards():
+    global awards, awards_by_projectID, awards_by_noticeNumber
+    awards = cached_awards()
+    awards_by_projectID = AwardIndex(awards, 'projectID')
+    awards_by_noticeNumber = AwardIndex(awards, 'noticeNumber')
+    print(f"Our database of awards contains {len(awards.index)} entries")
+    print(f"The median awarded price is {int(awards.price.median())}")
+    print(f"There are {len(awards.bidder.unique())} unique bidders")
+    print(f"There are {len(awards.contractor.unique())} unique contractors")
 
-def find_by_noticeNumber(noticeNumber: int):
-    return clean_awarded_df(awards[awards.noticeNumber == noticeNumber])
 
-
-decisions["found_projectID"] = decisions.projectIDs.str.len() > 0
-decisions["found_noticeNumber"] = decisions.noticeNumbers.str.len() > 0
-
-# retrieve the awards from the IntelliProcure export file and link it (just take the first found projectID or noticeNumber for simplicity)
-decisions['awards_found_by_projectID'] = decisions.apply(
-    lambda decision: find_by_projectID(decision.projectIDs[0]) if decision.projectIDs else None, axis=1)
-decisions['awards_found_by_noticeNumber'] = decisions.apply(
-    lambda decision: find_by_noticeNumber(decision.noticeNumbers[0]) if decision.noticeNumbers else None, axis=1)
-
-# split into non_re_identified and re_identified
-non_re_identified = decisions[decisions.awards_found_by_projectID.isna()
-                              & decisions.awards_found_by_noticeNumber.isna()]
-re_identified = decisions.dropna(subset=['awards_found_by_projectID', 'awards_found_by_noticeNumber'], how='all')
-
-# just combine all of the found awards (do not care for duplicate resolution for simplicity)
-re_identified['awards_found'] = re_identified.apply(
-    lambda x: x.awards_found_by_noticeNumber or x.awards_found_by_projectID, axis=1)
-
-# aggregate award prices
-re_identified['mean_price'] = re_identified.apply(
-    lambda x: np.mean(x.awards_found['prices']) if x.awards_found else None, axis=1)
-
-# just take the first bidder/contractor for simplicity
-re_identified['bidder'] = re_identified.apply(
-    lambda x: x.awards_found['bidders'][0] if x.awards_found else None, axis=1)
-re_identified['contractor'] = re_identified.apply(
-    lambda x: x.awards_found['contractors'][0] if x.awards_found else None, axis=1)
-re_identified['projectTitle'] = re_identified.apply(
-    lambda x: x.awards_found['projectTitle'] if x.awards_found else None, axis=1)
+def find_by_projectID(projectID: int):
+    return awards_by_projectID.find(projectID)
 
 
-def make_report(re_identified: DataFrame, decisions: DataFrame, language: str):
+def find_by_noticeNumber(noticeNumber: int):
+    return awards_by_noticeNumber.find(noticeNumber)
+
+
+def decision_keys(decisions: DataFrame):
+    # the decisions have no id, so they are identified by their language and urls, decisions without any url by
+    # their language and row in the decisions file (the index of the batches read by read_decisions)
+    return [f"{language}|{pdf_url}|{html_url}" if pd.notna(pdf_url) or pd.notna(html_url) else f"{language}|row {row}"
+            for language, pdf_url, html_url, row
+            in zip(decisions.language, decisions.pdf_url, decisions.html_url, decisions.index)]
+
+
+# raised whenever the stored linking results change, all decisions are then linked again
+RESULT_VERSION = 2
+# raised whenever the parsing of the extracted identifiers changes, the identifiers are then extracted again
+EXTRACTION_VERSION = 1
+
+
+def extraction_version():
+    # the stored identifiers are only reused if they were extracted with the same search queries and patterns
+    patterns = json.dumps({language: identifier_pattern(language) for language in search_queries}, sort_keys=True)
+    return text_hash(f"{EXTRACTION_VERSION}|{patterns}")
+
+
+summary_columns = ['mean_price', 'bidder', 'contractor', 'projectTitle']
+
+
+def link_decisions(decisions: DataFrame, store: ResultStore = None):
+    # extract the identifiers of a batch of decisions and link them to the awards, only the compact columns are kept
+    # With a store, the identifiers are only extracted for new or changed decisions (or after a change of the extraction)
+    # and only re-linked if the awards changed.
+    decisions = decisions.copy()
+    keys, hashes, stored = [], [], [None] * len(decisions.index)
+    if store is not None:
+        keys, hashes = decision_keys(decisions), [text_hash(text) for text in decisions.text]
+        extraction = extraction_version()
+        found = store.get(keys)
+        stored = [found[key] if key in found and found[key][0] == hash_
+                  and found[key][2].get('extraction_version') == extraction else None
+                  for key, hash_ in zip(keys, hashes)]
+
+    # Get the actual projectIDs and noticeNumbers from the text
+    projectIDs = [result[2]['projectIDs'] if result else None for result in stored]
+    noticeNumbers = [result[2]['noticeNumbers'] if result else None for result in stored]
+    changed = [position for position, result in enumerate(stored) if result is None]
+    with profiler.stage('extract_identifiers', len(changed)):
+        extracted = extract_identifiers(decisions.iloc[changed])
+    for position, changed_projectIDs, changed_noticeNumbers in zip(changed, *extracted):
+        projectIDs[position], noticeNumbers[position] = changed_projectIDs, changed_noticeNumbers
+    # object columns of lists, also for an empty batch (e.g. a shard without decisions of a language)
+    decisions['projectIDs'] = pd.Series(projectIDs, index=decisions.index, dtype=object)
+    decisions['noticeNumbers'] = pd.Series(noticeNumbers, index=decisions.index, dtype=object)
+
+    decisions = decisions.drop(columns=["text"])  # drop text so we can look at the df more easily
+
+    decisions["found_projectID"] = decisions.projectIDs.str.len() > 0
+    decisions["found_noticeNumber"] = decisions.noticeNumbers.str.len() > 0
+
+    # retrieve the awards from the IntelliProcure export file and link it (take the first projectID or noticeNumber found in the export)
+    # Only the linked identifier is kept per decision, the awards are the rows of its group in the award index.
+    linked = [result is not None and result[1] == store.data_version for result in stored]
+    with profiler.stage('link_awards', linked.count(False)):
+        linked_projectIDs = [result[2]['linked_projectID'] if is_linked else None
+                             for result, is_linked in zip(stored, linked)]
+        linked_noticeNumbers = [result[2]['linked_noticeNumber'] if is_linked else None
+                                for result, is_linked in zip(stored, linked)]
+        relinked = [position for position, is_linked in enumerate(linked) if not is_linked]
+        for position, projectID, noticeNumber in zip(
+                relinked, awards_by_projectID.find_first([projectIDs[position] for position in relinked]),
+                awards_by_noticeNumber.find_first([noticeNumbers[position] for position in relinked])):
+            linked_projectIDs[position], linked_noticeNumbers[position] = projectID, noticeNumber
+        decisions['linked_projectID'] = pd.array(linked_projectIDs, dtype='Int64')
+        decisions['linked_noticeNumber'] = pd.array(linked_noticeNumbers, dtype='Int64')
+
+        # the awards found by noticeNumber are preferred (no duplicate resolution for simplicity):
+        # aggregate their prices and just take the first bidder/contractor
+        by_noticeNumber = awards_by_noticeNumber.summaries(linked_noticeNumbers)
+        by_projectID = awards_by_projectID.summaries(linked_projectIDs)
+        summaries = by_noticeNumber.where(pd.Series(linked_noticeNumbers).notna(), by_projectID, axis=0)
+        summaries.index = decisions.index
+        decisions[summary_columns] = summaries[summary_columns]
+
+    if store is not None:
+        store.put([(key, hash_, {'projectIDs': projectIDs_, 'noticeNumbers': noticeNumbers_,
+                                 'linked_projectID': projectID, 'linked_noticeNumber': noticeNumber,
+                                 'extraction_version': extraction})
+                   for key, hash_, projectIDs_, noticeNumbers_, projectID, noticeNumber, is_linked
+                   in zip(keys, hashes, projectIDs, noticeNumbers, linked_projectIDs, linked_noticeNumbers, linked)
+                   if not is_linked])
+    return decisions
+
+
+def split_re_identified(decisions: DataFrame):
+    # split into non_re_identified and re_identified, the prices, bidders and projectTitles are linked already
+    linked = decisions.linked_projectID.notna() | decisions.linked_noticeNumber.notna()
+    return decisions[~linked], decisions[linked].copy()
+
+
+def write_result(df: DataFrame, path: str, output_format: str):
+    writer = result_writers[output_format](Path(path))
+    writer.write(df)
+    writer.close()
+
+
+class ReportAggregates:
+    """
+    All aggregates of the reports, computed in one grouped pass over the decisions with the language (or another slice
+    like the canton or year) as groupby key and an 'all' rollup, so the reports do not re-filter the frames per language.
+    """
+    count_columns = ['decisions', 'terms_found', 'terms_found_noticeNumber', 'terms_found_projectID', 're_identified',
+                     're_identified_noticeNumber', 're_identified_projectID', 'bvge_decisions', 'bvge_terms_found',
+                     'bvge_re_identified']
+
+    def __init__(self, re_identified: DataFrame, decisions: DataFrame):
+        self.flags = self.decision_flags(decisions)
+        self.counts = self.slice_counts('language')
+        self.courts = self.court_counts()
+
+        self.re_identified = re_identified.astype({'language': 'category', 'court': 'category'})
+        # sort by mean_price once, the per-language reports keep this order
+        self.re_identified = self.re_identified.sort_values(by='mean_price', ascending=False, kind='stable')
+        self.bidders = self.bidder_aggregates()
+
+    @staticmethod
+    def decision_flags(decisions: DataFrame):
+        court = decisions.court.astype('category')
+        # look up CH_BVGE once per court instead of once per decision and report
+        bvge = court.cat.categories.str.contains("CH_BVGE")
+        bvge = pd.Series(np.append(bvge, False)[court.cat.codes], index=decisions.index)  # code -1 is a missing court
+        terms_found = decisions.found_noticeNumber | decisions.found_projectID
+        re_identified_noticeNumber = decisions.linked_noticeNumber.notna()
+        re_identified_projectID = decisions.linked_projectID.notna()
+        re_identified = re_identified_noticeNumber | re_identified_projectID
+        return pd.DataFrame({
+            'language': decisions.language.astype('category'),
+            'court': court,
+            'canton': decisions.canton.astype('category'),
+            'year': pd.to_datetime(decisions.date.astype(str), errors='coerce').dt.year.astype('Int64'),
+            'decisions': 1,
+            'terms_found': terms_found,
+            'terms_found_noticeNumber': terms_found & decisions.found_noticeNumber,
+            'terms_found_projectID': terms_found & decisions.found_projectID,
+            're_identified': re_identified,
+            're_identified_noticeNumber': re_identified & re_identified_noticeNumber,
+            're_identified_projectID': re_identified & re_identified_projectID,
+            'bvge_decisions': bvge,
+            'bvge_terms_found': bvge & terms_found,
+            'bvge_re_identified': bvge & re_identified,
+        })
+
+    def slice_counts(self, by: str):
+        counts = self.flags.groupby(by, observed=True)[self.count_columns].sum()
+        counts.index = counts.index.astype(object)
+        counts.loc['all'] = counts.sum()
+        return counts
+
+    def court_counts(self):
+        columns = ['decisions', 'terms_found', 're_identified']
+        courts = self.flags.groupby(['language', 'court'], observed=True)[columns].sum()
+        all_courts = self.flags.groupby('court', observed=True)[columns].sum()
+        return {language: courts.loc[language] for language in courts.index.get_level_values(0).unique()} | {
+            'all': all_courts}
+
+    def bidder_aggregates(self):
+        # counts and price sums per language and bidder, the 'all' rollup adds them up over the languages
+        grouped = self.re_identified.groupby(['language', 'bidder'], observed=True).agg(
+            count=('mean_price', 'size'), price_sum=('mean_price', 'sum'), price_count=('mean_price', 'count'))
+        bidders = {language: grouped.loc[language] for language in grouped.index.get_level_values(0).unique()}
+        bidders['all'] = grouped.groupby(level='bidder').sum()
+        return bidders
+
+    def bidder_aggregate(self, language: str):
+        # calculate aggregates for the bidders (sum/mean of price and number of re-identifications
+        grouped = self.bidders.get(language, pd.DataFrame(columns=['count', 'price_sum', 'price_count']))
+        grouped = grouped.sort_index()
+        bidder_aggregate = pd.DataFrame({('bidder', 'count'): grouped['count'],
+                                         ('mean_price', 'sum'): grouped.price_sum,
+                                         ('mean_price', 'mean'): grouped.price_sum / grouped.price_count})
+        bidder_aggregate.index.name = 'bidder'
+        bidder_aggregate = bidder_aggregate.fillna(0)
+        bidder_aggregate.mean_price = bidder_aggregate.mean_price / 1000000
+        bidder_aggregate.mean_price = bidder_aggregate.mean_price.round(3)
+        bidder_aggregate = bidder_aggregate.sort_values(by=[('mean_price', 'sum'), ('bidder', 'count')],
+                                                        ascending=[False, False])
+        return bidder_aggregate.rename(
+            columns={'count': '# Re-Identifications', 'sum': 'Sum (M CHF)', 'mean': 'Mean (M CHF)'}, level=1)
+
+    def re_identified_of(self, language: str):
+        if language == 'all':
+            return self.re_identified
+        return self.re_identified[self.re_identified.language == language]
+
+
+def court_json(courts: DataFrame, column: str):
+    counts = courts[column]
+    return counts[counts > 0].sort_values(ascending=False, kind='stable').to_json()
+
+
+class ChartRenderer:
+    """
+    Collects the charts of all reports and renders them after the report data is written: as png all images are
+    exported in one session of the static-image exporter (kaleido), as html no exporter is needed at all.
+    Without a renderer (--charts none) plotly is not even imported.
+    """
+
+    def __init__(self, charts: str = 'png'):
+        self.charts = charts
+        self.pending = []  # (data, path without suffix)
+
+    def violin(self, prices: DataFrame, path: str):
+        self.pending.append((prices, path))
+
+    def render(self):
+        if not self.pending:
+            return
+        import plotly.express as px
+        import plotly.io as pio
+        figs = [px.violin(prices, y="mean_price", box=True,  # draw box plot inside the violin
+                          points='all',  # can be 'outliers', or False
+                          ) for prices, _ in self.pending]
+        paths = [f"{path}.{self.charts}" for _, path in self.pending]
+        self.pending = []
+        if self.charts == 'html':
+            for fig, path in zip(figs, paths):
+                fig.write_html(path, include_plotlyjs='cdn')
+            return
+        try:
+            if hasattr(pio, 'write_images'):  # plotly >= 6.1 renders all figures in one exporter session
+                pio.write_images(figs, paths)
+            else:
+                for fig, path in zip(figs, paths):
+                    fig.write_image(path)
+        except (ValueError, RuntimeError) as error:
+            # e.g. headless nodes without kaleido/chrome: the report data is already written
+            print(f"Could not render the charts as png ({error}), use --charts html or --charts none")
+
+
+chart_formats = ['png', 'html', 'none']
+
+
+def make_report(aggregates: ReportAggregates, language: str, output_format: str = 'csv', charts=None):
     print("\n\n")
     print("=" * 50)
     print(f"This is a report for the language {language}")
     print("=" * 50)
-    if language != 'all':
-        re_identified_lang = re_identified[re_identified.language == language]
-        decisions_lang = decisions[decisions.language == language]
-    else:
-        re_identified_lang = re_identified
-        decisions_lang = decisions
-
-    terms_found_lang = decisions_lang[decisions_lang.found_noticeNumber | decisions_lang.found_projectID]
+    counts = aggregates.counts.loc[language] if language in aggregates.counts.index \
+        else pd.Series(0, index=aggregates.count_columns)
+    courts = aggregates.courts.get(language, pd.DataFrame(columns=['decisions', 'terms_found', 're_identified']))
+    re_identified_lang = aggregates.re_identified_of(language)
 
-    num_decisions = len(decisions_lang.index)
-    num_terms_found = len(terms_found_lang.index)
+    num_decisions = int(counts.decisions)
+    num_terms_found = int(counts.terms_found)
     num_re_identified = len(re_identified_lang.index)
     re_identification = {
         "re_identified":
             {
-                "noticeNumber": re_identified_lang.awards_found_by_noticeNumber.count(),
-                "projectID": re_identified_lang.awards_found_by_projectID.count(),
+                "noticeNumber": counts.re_identified_noticeNumber,
+                "projectID": counts.re_identified_projectID,
                 "total": num_re_identified,
             },
         "terms_found":
             {
-                "noticeNumber": (terms_found_lang.noticeNumbers.str.len() > 0).sum(),
-                "projectID": (terms_found_lang.projectIDs.str.len() > 0).sum(),
+                "noticeNumber": counts.terms_found_noticeNumber,
+                "projectID": counts.terms_found_projectID,
                 "total": num_terms_found,
             },
     }
@@ -184,56 +540,171 @@ def make_report(re_identified: DataFrame, decisions: DataFrame, language: str):
 
     pprint(re_identification)
 
-    print(f"We found decisions from the following courts: {decisions_lang.court.value_counts().to_json()}")
-    print(f"We found terms in decisions from the following courts: {terms_found_lang.court.value_counts().to_json()}")
-    print(f"We re-identified decisions from the following courts: {re_identified_lang.court.value_counts().to_json()}")
-    bvge_percentage_total = len(decisions_lang[decisions_lang.court.str.contains("CH_BVGE")].index) / num_decisions
-    bvge_percentage_terms_found = len(
-        terms_found_lang[terms_found_lang.court.str.contains("CH_BVGE")].index) / num_terms_found
-    bvge_percentage_re_identified = len(
-        re_identified_lang[re_identified_lang.court.str.contains("CH_BVGE")].index) / num_re_identified
+    print(f"We found decisions from the following courts: {court_json(courts, 'decisions')}")
+    print(f"We found terms in decisions from the following courts: {court_json(courts, 'terms_found')}")
+    print(f"We re-identified decisions from the following courts: {court_json(courts, 're_identified')}")
+    bvge_percentage_total = counts.bvge_decisions / num_decisions
+    bvge_percentage_terms_found = counts.bvge_terms_found / num_terms_found
+    bvge_percentage_re_identified = counts.bvge_re_identified / num_re_identified
     print(f"CH_BVGE makes up {bvge_percentage_total * 100:2.2f}% of total decisions, "
           f"{bvge_percentage_terms_found * 100:2.2f}% of terms-found decisions "
           f"and {bvge_percentage_re_identified * 100:2.2f}% of re-identified decisions")
 
     print(f"Find a randomly chosen re-identified sample below:")
-    random_sample = re_identified_lang.iloc[random.randint(0, num_re_identified)]
-    print(random_sample[['awards_found_by_projectID', 'awards_found_by_noticeNumber']])
+    random_sample = re_identified_lang.iloc[random.randrange(num_re_identified)]
+    print(random_sample[['linked_projectID', 'linked_noticeNumber'] + summary_columns])
 
     # draw violin plot for prices
     # häufig rahmenverträge, müssen nicht alle Leistungen bezogen werden
-    prices = re_identified_lang[re_identified_lang.mean_price > 0]
-    fig = px.violin(prices, y="mean_price", box=True,  # draw box plot inside the violin
-                    points='all',  # can be 'outliers', or False
-                    )
-    fig.write_image(f'results/{language}_price_distribution.png')
+    if charts is not None:
+        prices = re_identified_lang[re_identified_lang.mean_price > 0]
+        charts.violin(prices[['mean_price']], f'results/{language}_price_distribution')
 
-    # sort by mean_price
-    re_identified_lang = re_identified_lang.sort_values(by='mean_price', ascending=False)
-
-    # save all re-identifications
-    re_identified_lang.to_csv(f"results/{language}_re_identifications.csv")
+    # save all re-identifications (sorted by mean_price)
+    write_result(re_identified_lang, f"results/{language}_re_identifications", output_format)
 
     # find bidders associated with highest prices
     high_bidder_threshold = 50000000  # this applies to many bidders in German decisions and to a few in the other langs
     high_bidders = re_identified_lang[re_identified_lang.mean_price > high_bidder_threshold]
-    high_bidders.to_csv(f"results/{language}_high_bidders.csv")
-
-    # calculate aggregates for the bidders (sum/mean of price and number of re-identifications
-    bidder_aggregate = re_identified_lang.groupby(by="bidder").agg({'bidder': 'count', 'mean_price': ['sum', 'mean']})
-    bidder_aggregate = bidder_aggregate.fillna(0)
-    bidder_aggregate.mean_price = bidder_aggregate.mean_price / 1000000
-    bidder_aggregate.mean_price = bidder_aggregate.mean_price.round(3)
-    bidder_aggregate = bidder_aggregate.sort_values(by=[('mean_price', 'sum'), ('bidder', 'count')],
-                                                    ascending=[False, False])
-    bidder_aggregate = bidder_aggregate.rename(
-        columns={'count': '# Re-Identifications', 'sum': 'Sum (M CHF)', 'mean': 'Mean (M CHF)'}, level=1)
-    bidder_aggregate.to_csv(f"results/{language}_bidder_aggregate.csv")
-
-    # TODO we could also optionally discuss the development over the years
-
-
-make_report(re_identified, decisions, 'all')
-make_report(re_identified, decisions, 'de')
-make_report(re_identified, decisions, 'fr')
-make_report(re_identified, decisions, 'it')
+    write_result(high_bidders, f"results/{language}_high_bidders", output_format)
+
+    write_result(aggregates.bidder_aggregate(language), f"results/{language}_bidder_aggregate", output_format)
+
+
+def make_reports(re_identified: DataFrame, decisions: DataFrame, slices=(), output_format: str = 'csv',
+                 charts: str = 'png'):
+    aggregates = ReportAggregates(re_identified, decisions)
+    renderer = ChartRenderer(charts) if charts != 'none' else None
+    for language in ['all'] + list(search_queries.keys()):
+        make_report(aggregates, language, output_format, renderer)
+    # development over the years, per canton, ...: the same counts per value of another column
+    for by in slices:
+        write_result(aggregates.slice_counts(by), f"results/{by}_summary", output_format)
+    if renderer is not None:
+        with profiler.stage('render_charts', len(renderer.pending)):
+            renderer.render()
+
+
+"""
+Sharded runs (see shared/sharding.py): the decisions are sharded by their decision_keys, a shard writes its linked
+decisions to results/shards and the merge orders them by language, then row of the decisions file, before the reports.
+"""
+SHARD_DIR = Path('results/shards')
+# the columns the partial results store as JSON
+nested_columns = ['projectIDs', 'noticeNumbers']
+
+
+def shard_path(index: int, count: int):
+    return SHARD_DIR / f'linked_decisions-{index}-of-{count}.parquet'
+
+
+def write_shard(decisions: DataFrame, index: int, count: int):
+    # written under a temporary name first, so only complete shards are merged. A shard without decisions
+    # (more shards than decisions) is written as an empty file, the merge then knows it is complete
+    SHARD_DIR.mkdir(parents=True, exist_ok=True)
+    partial = ParquetWriter(SHARD_DIR / f'linked_decisions-{index}-of-{count}-partial')
+    partial.write(decisions)
+    partial.close()
+    partial.path.replace(shard_path(index, count))
+
+
+def merge_shards(count: int):
+    missing = [index for index in range(count) if not shard_path(index, count).exists()]
+    if missing:
+        raise FileNotFoundError(f"the shards {missing} of {count} have not been written (yet)")
+    decisions = pd.concat([pd.read_parquet(shard_path(index, count)) for index in range(count)])
+    for column in nested_columns:
+        decisions[column] = [json.loads(value) if isinstance(value, str) else None for value in decisions[column]]
+    language_order = decisions.language.map({language: order for order, language in enumerate(search_queries)})
+    return decisions.iloc[np.lexsort((decisions.index.to_numpy(), language_order.to_numpy()))]
+
+
+def report(decisions: DataFrame, args):
+    num_decisions = len(decisions.index)
+    terms = []
+    for queries in search_queries.values():
+        terms.append(queries['projectID'])
+        terms.append(queries['noticeNumber'])
+    print(f"Found {num_decisions} decisions containing at least one of the following terms {terms}")
+
+    with profiler.stage('split_re_identified', num_decisions):
+        non_re_identified, re_identified = split_re_identified(decisions)
+
+    with profiler.stage('make_reports', len(re_identified.index)):
+        make_reports(re_identified, decisions, args.slices, args.output_format, args.charts)
+
+
+profiled_stages = ['load_awards', 'prepare_awards', 'prepare_decisions', 'extract_identifiers', 'link_awards',
+                   'write_results', 'split_re_identified', 'make_reports', 'render_charts', 'merge_shards']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-identify Swiss court decisions with awards from SIMAP")
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help="read and link the decisions in batches of this many rows, "
+                             "so peak memory depends on the batch size and not on the corpus size")
+    parser.add_argument('--store', default=None,
+                        help="SQLite file with the results of earlier runs, "
+                             "only new or changed decisions are processed and only re-linked if the awards changed")
+    parser.add_argument('--slices', nargs='*', default=[], choices=['canton', 'court', 'year'],
+                        help="additionally write the report counts per canton, court or year to results/<slice>_summary.csv")
+    parser.add_argument('--output-format', default='csv', choices=result_writers.keys(),
+                        help="format of the result files, the linked decisions are appended batch by batch")
+    parser.add_argument('--charts', default='png', choices=chart_formats,
+                        help="render the price distributions as png (one exporter session for all languages), "
+                             "as html (no exporter needed) or not at all for data-only runs")
+    parser.add_argument('--profile', default='results/run_profile.json',
+                        help="JSON file with the wall time, CPU time, peak RSS and rows of every stage of the run")
+    parser.add_argument('--cprofile', default=None, choices=profiled_stages,
+                        help="additionally run this stage under cProfile, the stats are written next to the profile")
+    parser.add_argument('--shard', type=parse_shard, default=None, metavar='INDEX/COUNT',
+                        help="only link the decisions of shard INDEX (0-based) of COUNT and write them to results/shards")
+    parser.add_argument('--merge', type=int, default=None, metavar='COUNT',
+                        help="merge the results of COUNT shards and write the linked decisions and reports")
+    args = parser.parse_args()
+    profiler.cprofile_stage = args.cprofile
+
+    if args.merge:
+        with profiler.stage('merge_shards') as stage:
+            decisions = merge_shards(args.merge)
+            stage["rows"] = len(decisions.index)
+        with profiler.stage('write_results', len(decisions.index)):
+            write_result(decisions, 'results/linked_decisions', args.output_format)
+        report(decisions, args)
+        profiler.write(Path(args.profile), pipeline='simap', args=vars(args))
+        return
+
+    with profiler.stage('load_awards') as stage:
+        load_awards()
+        stage["rows"] = len(awards.index)
+    store = ResultStore(args.store, f"{file_hash(awards_path())}-v{RESULT_VERSION}") if args.store else None
+
+    linked_writer = result_writers[args.output_format](Path('results/linked_decisions')) if not args.shard else None
+    batches = []
+    for batch in profiler.batches('prepare_decisions', read_decisions(args.chunksize)):
+        if args.shard:
+            index, count = args.shard
+            batch = batch[shard_of(decision_keys(batch), count) == index]
+        batch = link_decisions(batch, store)
+        if linked_writer is not None:
+            with profiler.stage('write_results', len(batch.index)):
+                linked_writer.write(batch)
+        batches.append(batch)
+    decisions = pd.concat(batches)
+
+    if args.shard:
+        with profiler.stage('write_results', len(decisions.index)):
+            write_shard(decisions, *args.shard)
+        print(f"Linked {len(decisions.index)} decisions of shard {args.shard[0]} of {args.shard[1]}")
+        profile = Path(args.profile)
+        profiler.write(profile.with_name(f"{profile.stem}-{args.shard[0]}-of-{args.shard[1]}{profile.suffix}"),
+                       pipeline='simap', args=vars(args))
+        return
+
+    linked_writer.close()
+    report(decisions, args)
+    profiler.write(Path(args.profile), pipeline='simap', args=vars(args))
+
+
+if __name__ == '__main__':
+    main()
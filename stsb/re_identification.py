@@ -1,27 +1,52 @@
+import argparse
 import json
 import csv
+import os
+import sys
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from pandas import DataFrame
 import datetime
+import html
 import re 
 import itertools
+import functools
+import importlib.metadata
+import multiprocessing
 from pathlib import Path
-import nltk
-nltk.download('punkt')
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
+#NLTK data is only read from the local NLTK data path (e.g. NLTK_DATA), install it once with
+#python -m nltk.downloader stopwords
+from nltk.corpus import stopwords as nltk_stopwords
 
-import spacy
-from spacy import displacy
-from spacy.matcher import Matcher
+#spaCy models are only loaded when ner() needs them for a language, see load_nlp
+nlp_model_names = {"de": "nl_core_news_md", "fr": "fr_core_news_sm", "it": "it_core_news_sm", "en": "en_core_web_sm"}
 
-de_nlp = spacy.load("nl_core_news_md")
-fr_nlp= spacy.load("fr_core_news_sm")
-it_nlp= spacy.load("it_core_news_sm")
-en_nlp= spacy.load("en_core_web_sm")
+@functools.lru_cache(maxsize=None)
+def load_nlp(lang):
+    import spacy
+    return spacy.load(nlp_model_names[lang])
+
+#the modules shared with the SIMAP pipeline are in the shared folder of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from shared.cache import cached_parquet
+from shared.profiling import StageProfiler
+from shared.sharding import parse_shard, shard_of
+from shared.store import ResultStore, file_hash, text_hash
+from shared.writers import ParquetWriter, result_writers
 
 DATA_DIR = Path('data')
+CACHE_DIR = Path('cache')
+
+"""
+Stage instrumentation: the profiler records wall time, CPU time, peak RSS and row counts per stage (loading,
+preprocessing, extraction, linking, NER, writing). Stages that run once per batch are summed up, stages can be nested
+(stsb_events is part of load_events). The peak RSS is the peak of the whole process at the end of a stage. With
+--workers the stages inside the workers (build_scorers, extract_identifiers, select_events) are not recorded and
+only seen as part of link_aviation and link_trains_and_ships, whose CPU time is then mostly spent in the workers.
+The profile is written as JSON, one stage can additionally be run under cProfile.
+"""
+profiler = StageProfiler()
 
 """
 prepare_decisions function build a dataframe of decisions which are related to STSB events
@@ -30,43 +55,55 @@ prepare_decisions function build a dataframe of decisions which are related to S
 17 decisions in fr.
 3 decisions in it.
 """
-def prepare_decisions():
-    df = pd.read_csv(DATA_DIR / 'decisions.csv')
-    interesting_cols = ['file_id','language', 'canton_name', 'court_name', 'chamber_string', 'date', 'pdf_url', 'html_url', 'text']
-    df['text'] = df['pdf_raw'].astype(str) + df['html_raw'].astype(str)
-    return df[interesting_cols]
-    
-decisions=prepare_decisions()
-num_decisions = len(decisions.index)
-print(f"Found {num_decisions} decisions containing at least one of the following terms SUST,STSB,SISI,SESE")
+decision_cols = ['file_id','language', 'canton_name', 'court_name', 'chamber_string', 'date', 'pdf_url', 'html_url']
 
-de_decisions= len(decisions[(decisions['language']=='de')])
-print(f"Found {de_decisions} decisions in German languages")
+"""
+Text normalization: the text of a decision is normalized once when it is read. The markup of the html body is
+stripped, html entities (e.g. n&#176;) are unescaped, whitespace is collapsed and the text is lowercased. Of the pdf
+and the html body, which mostly hold the same decision, only the longer one is kept, so every decision is scanned once.
+All matchers then run case-sensitive with lowercased identifiers. Set NORMALIZE_TEXT to False to scan the raw
+concatenation of both bodies case-insensitively as before.
+"""
+NORMALIZE_TEXT = True
 
-fr_decisions= len(decisions[(decisions['language']=='fr')])
-print(f"Found {fr_decisions} decisions in French languages")
+def normalize_body(body, markup=False):
+    body = body.fillna('').astype(str)
+    if markup:
+        body = body.str.replace(r'<[^>]*>', ' ', regex=True)
+    body = body.map(html.unescape)
+    return body.str.replace(r'\s+', ' ', regex=True).str.strip().str.lower()
 
-it_decisions= len(decisions[(decisions['language']=='it')])
-print(f"Found {it_decisions} decisions in Italian languages")
+def normalize_text(pdf_raw, html_raw):
+    pdf_body, html_body = normalize_body(pdf_raw), normalize_body(html_raw, markup=True)
+    return pdf_body.where(pdf_body.str.len() >= html_body.str.len(), html_body)
 
+#with a chunksize the decisions are read in batches of chunksize rows, so only one batch of texts is in memory
+def prepare_decisions(chunksize=None):
+    df = pd.read_csv(DATA_DIR / 'decisions.csv', usecols=decision_cols + ['pdf_raw', 'html_raw'], chunksize=chunksize)
+    batches = [df] if chunksize is None else df
+    for batch in batches:
+        if NORMALIZE_TEXT:
+            batch['text'] = normalize_text(batch['pdf_raw'], batch['html_raw'])
+        else:
+            batch['text'] = batch['pdf_raw'].astype(str) + batch['html_raw'].astype(str)
+        yield batch[decision_cols + ['text']]
+    
 """
 stsb_events function build a dataframe of events related to aviation or trains and ships.
 Our database of aviation events contains 1944 entries
 Our database of trains and ships events contains 777 entries
 """
+event_files = ['aviatik.json', 'bahnen_und_schiffe.json']
+
 def stsb_events(file):
     stsb_file = DATA_DIR / file
-    with open(stsb_file, 'r') as f:
-         data = json.load(f)
-    df = pd.DataFrame(data)
+    with profiler.stage('stsb_events') as stage:
+        with open(stsb_file, 'r') as f:
+             data = json.load(f)
+        df = pd.DataFrame(data)
+        stage["rows"] = len(df.index)
     return df
 
-aviation =  stsb_events('aviatik.json')
-trains_and_ships =  stsb_events('bahnen_und_schiffe.json')
-
-print(f"Our database of aviation events contains {len(aviation.index)} entries") 
-print(f"Our database of trains and ships events contains {len(trains_and_ships.index)} entries")
-
 #Converts date format from 26. 05. 2016 to 26. Mai 2016 based on decision languages. we need this to search it in decision text. 
 dic= {
     "de": {"January": "Januar",
@@ -106,15 +143,38 @@ dic= {
            "November": "novembre",
            "December": "dicembre",},
 }
+#Converted dates are cached since every event date is looked up once per decision language
+@functools.lru_cache(maxsize=None)
 def convert_date(e_date,lang):
     idx =pd.to_datetime(e_date,dayfirst=True)
     en_month = idx.strftime("%B")
     month = dic[lang][en_month]
     date1 = idx.strftime("%d")+" "+month+" "+idx.strftime("%Y")
     date2 = idx.strftime("%d")+". "+month+" "+idx.strftime("%Y")
-    date = [str(date1),str(date2)]
+    date = (str(date1),str(date2))
     return date
 
+"""
+Date blocking: the dates in a decision are extracted once with the month names of all languages (with and without
+the dot after the day) and looked up in a date -> events map built ahead of time. Only events whose date appears in
+the decision are scored. If no event date appears, we fall back to the events whose report number appears.
+Events without a date match can then no longer be linked by their other identifiers alone, set DATE_BLOCKING to
+False to score every candidate event.
+"""
+DATE_BLOCKING = True
+
+month_numbers = {month.lower(): number for months in dic.values() for number, month in enumerate(months.values(), 1)}
+#same as the date patterns of convert_date, where the dot after the day matches any character
+date_regex = re.compile(r'\b(\d{2}).? (%s) (\d{4})\b' % '|'.join(sorted(month_numbers, key=len, reverse=True)),
+                        0 if NORMALIZE_TEXT else re.IGNORECASE)
+
+def decision_dates(text):
+    return {(int(year), month_numbers[month.lower()], int(day)) for day, month, year in date_regex.findall(text)}
+
+def event_date_key(e_date):
+    idx = pd.to_datetime(e_date,dayfirst=True)
+    return (idx.year, idx.month, idx.day)
+
 """
 clean location and details information in stsb data and remove any words which not used as identifier.
 for example: "HB-KLT ROBIN AIRCRAFT ROBIN DR 400/160FlugzeugBetriebsart: SchulungFlugregeln: VFR" I remove "SchulungFlugregeln" and "FlugzeugBetriebsart" and "VFR".
@@ -127,20 +187,34 @@ ineffective_words = ["schweizer","lange","FLUGZEUGBAU","flight","technische","a
                 "CORPORATION","HELICOPTER","HÉLICOPTÈRES","BedarfsfliegereiFlugregeln","ArbeitsflugFlugregeln",
                 "RettungseinsätzeFlugregeln","MilitärFlugregeln","Eigenbau","GMBH","Helikopter","flugregeln","flug"]
 
-stopwords = stopwords.words('english')+ stopwords.words('dutch') + stopwords.words('german') +stopwords.words('italian')+stopwords.words('french')
+"""
+The event tables are prepared column by column instead of row by row: the texts are cleaned and split with pandas
+string methods and the stopwords are looked up in a frozenset. The split follows nltk's word_tokenize for these
+texts: quotes, brackets, [;@#$%&?!*], en and em dashes separate words and clitics like 's or n't are words of their own,
+only the multi-word contractions of word_tokenize (e.g. cannot) are not split.
+"""
+@functools.lru_cache(maxsize=None)
+def load_stopwords():
+    return frozenset(nltk_stopwords.words('english') + nltk_stopwords.words('dutch') + nltk_stopwords.words('german')
+                     + nltk_stopwords.words('italian') + nltk_stopwords.words('french'))
+
+big_regex = re.compile('|'.join(ineffective_words),re.IGNORECASE)
+token_separators = re.compile(r"[«“‘„`»”’\"\[\](){}<>;@#$%&?!*\u2012-\u2015]|--|''")
+token_quotes = re.compile(r"(?i)(?<!\w)'(?!(?:re|ve|ll|m|t|s|d|n)\b)(?=\w)")
+token_clitics = re.compile(r"(?<=[^'\s])('[sSmMdD]|'ll|'LL|'re|'RE|'ve|'VE|n't|N'T|')(?=\s|$)")
+
+def clean_column(data):
+    d = data.str.replace(r"[.,():]", "", regex=True)
+    d = d.str.replace(big_regex, " ", regex=True)
+    d = d.str.replace(token_separators, " ", regex=True)
+    d = d.str.replace(token_quotes, "' ", regex=True)
+    d = d.str.replace(token_clitics, r" \1", regex=True)
+    stopwords = load_stopwords()
+    return [[w for w in word_tokens if len(w)>2 and not w.isdigit() and not w.lower() in stopwords]
+            for word_tokens in d.str.split()]
 
 def clean_data(data):
-    d = re.sub("[.,():]","",data)
-    big_regex = re.compile('|'.join(ineffective_words),re.IGNORECASE)
-    d = big_regex.sub(" ", d)
-    word_tokens = word_tokenize(d)
-    filtered_words = [w for w in word_tokens if not w.lower() in stopwords and len(w)>2 and not w.isdigit()]
-    return filtered_words
-
-aviation['location_list'] = aviation.apply(
-    lambda aviation: clean_data(aviation.location), axis=1)
-aviation['details_list'] = aviation.apply(
-    lambda aviation: clean_data(aviation.details), axis=1)
+    return clean_column(pd.Series([data]))[0]
 
 #Extraxt Time,pist and report numbers from content of events. I used these as indirect identifier. 
 reg_query ={
@@ -150,32 +224,195 @@ reg_query ={
     "report_number": r'Schlussbericht Nr.\s*[0-9]+|Rapport final n°\s[0-9]+',
 }
 
-def extraxt_content_identifier(content,reg):
+"""
+The non-English contents of an event are joined once (in reverse order, like they always were) and all patterns of
+an event table are searched in that one document. One regex per pattern is faster than a single alternation of all
+patterns, which Python's re can no longer scan for the literal start of each pattern.
+"""
+def event_document(content):
     doc= ""
     for each in content:
         lang = each["lang"]
         if lang == "en" or lang == "no":
             pass
         else:
-            doc = each["content"] + doc   
-    match = re.findall(reg,doc)
-    keywords=list(set(filter(None,match))) 
-    if not keywords:
+            doc = each["content"] + doc
+    return doc
+
+def extraxt_content_identifiers(contents, kinds):
+    regexes = {kind: re.compile(reg_query[kind]) for kind in kinds}
+    patterns = {kind: [] for kind in kinds}
+    for content in contents:
+        doc = event_document(content)
+        for kind, regex in regexes.items():
+            patterns[kind].append(list(set(filter(None, regex.findall(doc)))) or None)
+    return patterns
+
+def prepare_aviation():
+    aviation =  stsb_events(event_files[0])
+    with profiler.stage('clean_data', len(aviation.index)):
+        aviation['location_list'] = clean_column(aviation.location)
+        aviation['details_list'] = clean_column(aviation.details)
+    with profiler.stage('extraxt_content_identifier', len(aviation.index)):
+        patterns = extraxt_content_identifiers(aviation.content, ["time", "pist", "report_number"])
+        for kind, found in patterns.items():
+            aviation[f'{kind}_pattern'] = found
+    return aviation
+
+def prepare_trains_and_ships():
+    trains_and_ships =  stsb_events(event_files[1])
+    with profiler.stage('clean_data', len(trains_and_ships.index)):
+        trains_and_ships['location_list'] = clean_column(trains_and_ships.location)
+        trains_and_ships['details_list'] = clean_column(trains_and_ships.type)
+    with profiler.stage('extraxt_content_identifier', len(trains_and_ships.index)):
+        patterns = extraxt_content_identifiers(trains_and_ships.content, ["time", "wagon", "report_number"])
+        for kind, found in patterns.items():
+            trains_and_ships[f'{kind}_pattern'] = found
+    return trains_and_ships
+
+aviation_columns = ['id', 'event_date', 'location', 'details', 'content', 'location_list', 'details_list',
+                    'time_pattern', 'pist_pattern', 'report_number_pattern']
+train_columns = ['id', 'event_date', 'location', 'type', 'content', 'location_list', 'details_list',
+                 'time_pattern', 'wagon_pattern', 'report_number_pattern']
+
+"""
+The prepared event tables are cached as parquet files in CACHE_DIR and read memory-mapped on later runs, see
+shared/cache.py. PREPARE_VERSION is raised whenever the preparation itself changes.
+"""
+PREPARE_VERSION = 2
+
+def cached_table(file, prepare, columns):
+    return cached_parquet(DATA_DIR / file, CACHE_DIR, PREPARE_VERSION, lambda: prepare()[columns])
+
+aviation = None
+trains_and_ships = None
+
+def load_events():
+    global aviation, trains_and_ships
+    aviation = cached_table(event_files[0], prepare_aviation, aviation_columns)
+    trains_and_ships = cached_table(event_files[1], prepare_trains_and_ships, train_columns)
+    print(f"Our database of aviation events contains {len(aviation.index)} entries") 
+    print(f"Our database of trains and ships events contains {len(trains_and_ships.index)} entries")
+
+"""
+Scanning every event for every decision grows with decisions x events. Instead, all identifiers of an event table
+(dates, location_list, details_list, time, pist, wagon and report number patterns) go into an inverted index keyed by
+their words. A decision is tokenized once and only events with at least one identifier whose words all occur in the
+decision are scored with find_match. Events without any hit score 0 and can never pass the threshold,
+so the linked event_id stays the same.
+"""
+_regex_structure = re.compile(r'[\[\]{}()|\\]')
+_regex_operators = '.^$*+?'
+
+#Words that have to appear as whole words in any text the identifier matches, None if we cannot tell
+def index_tokens(identifier):
+    if _regex_structure.search(identifier):
         return None
-    else:
-        return keywords
-    
-aviation['time_pattern'] = aviation.apply(
-    lambda aviation: extraxt_content_identifier(aviation.content,reg_query["time"]), axis=1)
-aviation['pist_pattern'] = aviation.apply(
-    lambda aviation: extraxt_content_identifier(aviation.content,reg_query["pist"]), axis=1)
-aviation['report_number_pattern'] = aviation.apply(
-    lambda aviation: extraxt_content_identifier(aviation.content,reg_query["report_number"]), axis=1)
+    tokens = set()
+    for word in re.finditer(r'\w+', identifier):
+        before = identifier[word.start() - 1] if word.start() > 0 else ""
+        after = identifier[word.end()] if word.end() < len(identifier) else ""
+        # e.g. "Nr." in report numbers: the dot matches any character, so "nr" need not be a whole word
+        if (before and before in _regex_operators) or (after and after in _regex_operators):
+            continue
+        tokens.add(word.group().casefold())
+    return frozenset(tokens) if tokens else None
+
+def text_tokens(text):
+    return set(re.findall(r'\w+', text.casefold()))
+
+class EventIndex:
+    def __init__(self, identifiers):
+        # identifiers: one list of identifier strings per event, in the order of the event table
+        self.postings = {}
+        self.always = set()
+        for position, event_identifiers in enumerate(identifiers):
+            for identifier in event_identifiers:
+                tokens = index_tokens(identifier)
+                if tokens is None:
+                    self.always.add(position)
+                    continue
+                # one posting per identifier under its longest word, the other words are checked on lookup
+                anchor = max(tokens, key=len)
+                self.postings.setdefault(anchor, []).append((position, tokens))
+
+    def candidates(self, text):
+        tokens = text_tokens(text)
+        found = set(self.always)
+        for token in tokens:
+            for position, identifier_tokens in self.postings.get(token, ()):
+                if position not in found and identifier_tokens <= tokens:
+                    found.add(position)
+        return sorted(found)
+
+def event_identifiers(event, lang, columns):
+    identifiers = list(convert_date(event["event_date"], lang))
+    for column in columns:
+        if event[column] is not None:
+            identifiers.extend(event[column])
+    return identifiers
+
+def wagon_variants(wagon):
+    #wagon numbers are sometimes only found with the html entity of the degree sign (in texts that are not normalized)
+    return [item.replace('n°','n&#176;') for item in wagon]
+
+event_indexes = {}
+
+def event_index(events, name, lang, columns):
+    key = (name, lang)
+    if key not in event_indexes:
+        identifiers = []
+        for _, event in events.iterrows():
+            identifiers_of_event = event_identifiers(event, lang, columns)
+            if "wagon_pattern" in columns and event["wagon_pattern"] is not None:
+                identifiers_of_event.extend(wagon_variants(event["wagon_pattern"]))
+            identifiers.append(identifiers_of_event)
+        event_indexes[key] = EventIndex(identifiers)
+    return event_indexes[key]
+
+date_blocks = {}
+
+#the events per date and the report numbers per event, for the fallback without a matching date
+def date_block(events, name):
+    if name not in date_blocks:
+        events_by_date = {}
+        for position, e_date in enumerate(events["event_date"]):
+            events_by_date.setdefault(event_date_key(e_date), []).append(position)
+        date_blocks[name] = (events_by_date, events["report_number_pattern"].tolist())
+    return date_blocks[name]
+
+def block_by_date(events, name, candidates, text):
+    events_by_date, report_numbers = date_block(events, name)
+    on_dates = set()
+    for date in decision_dates(text):
+        on_dates.update(events_by_date.get(date, ()))
+    shortlist = [position for position in candidates if position in on_dates]
+    if shortlist:
+        return shortlist
+    return [position for position in candidates
+            if report_numbers[position] is not None and find_match(report_numbers[position], text) is not None]
+
+aviation_identifier_columns = ['location_list', 'details_list', 'time_pattern', 'pist_pattern', 'report_number_pattern']
+
+def identifier_pattern(search_list):
+    pattern = '|'.join(search_list)
+    #normalized texts are lowercase, so the lowercased identifiers are enough unless lowercasing changes an escape
+    if NORMALIZE_TEXT and '\\' not in pattern:
+        return re.compile(r'\b(?:%s)\b' % re.sub(r'\s+', ' ', pattern).lower())
+    return re.compile(r'\b(?:%s)\b' % pattern,re.IGNORECASE)
+
+#Compiled identifier patterns of find_match are cached per event and identifier kind so they are compiled once per run
+#(the sparse scorers keep their own compiled terms). compile_identifiers.cache_info() reports the hits and misses.
+PATTERN_CACHE_SIZE = 2 ** 16
+
+@functools.lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_identifiers(search_list):
+    return identifier_pattern(search_list)
 
 #Find list of identifiers in decision text
 def find_match(search_list,text):
-    pattern =re.compile(r'\b(?:%s)\b' % '|'.join(search_list),re.IGNORECASE)
-    match = re.findall(pattern,text)
+    pattern = compile_identifiers(tuple(search_list))
+    match = pattern.findall(text)
     if not match:
         return None
     else:
@@ -188,7 +425,10 @@ based on score of identifiers we can link more similar events to decisions.
 """
 def get_identifiers(text,lang,file_id):
     find_list = []
-    for row in aviation.iterrows():
+    candidates = event_index(aviation, "aviation", lang, aviation_identifier_columns).candidates(text)
+    if DATE_BLOCKING:
+        candidates = block_by_date(aviation, "aviation", candidates, text)
+    for row in aviation.iloc[candidates].iterrows():
         score = 0
         kw = []
         id = row[1]["id"]  
@@ -202,105 +442,135 @@ def get_identifiers(text,lang,file_id):
         
         matched_date =find_match(date_key,text)
         if  matched_date is not None:
-            score = len(matched_date) * 3 + score
+            score = len(matched_date) * aviation_weights["date"] + score
             kw.append(matched_date)
         
         matched_loc =find_match(loc,text)
         if  matched_loc is not None:
-            score = len(matched_loc) * 1 + score
+            score = len(matched_loc) * aviation_weights["location_list"] + score
             kw.append(matched_loc)
 
         matched_details =find_match(det,text)
         if  matched_details is not None:
-            score = len(matched_details) * 2  + score
+            score = len(matched_details) * aviation_weights["details_list"] + score
             kw.append(matched_details)  
 
         if  report_number is not None:
             matched_report_number =find_match(report_number,text)
             if  matched_report_number is not None:
-                score = len(matched_report_number) * 3 + score
+                score = len(matched_report_number) * aviation_weights["report_number_pattern"] + score
                 kw.append(matched_report_number)
         else:
             pass
         if  time is not None:
             matched_time =find_match(time,text)
             if  matched_time is not None:
-                score = len(matched_time) * 2 + score
+                score = len(matched_time) * aviation_weights["time_pattern"] + score
                 kw.append(matched_time)
         else:
             pass 
         if  pist is not None:
             matched_pist =find_match(pist,text)
             if  matched_pist is not None:
-                score = len(matched_pist) * 1 + score
+                score = len(matched_pist) * aviation_weights["pist_pattern"] + score
                 kw.append(matched_pist)
         else:
             pass
         find_list.append([id,score,kw])
     
+    if not find_list:
+        return None
     max_score = max(find_list, key=lambda x: x[1])
-    if max_score[1] > 4:
+    if max_score[1] > thresholds["aviation"]:
         return max_score[0]
     else:
         return None
 
-decisions['event_id'] = decisions.apply(
-    lambda decision: get_identifiers(decision.text, decision.language,decision.file_id), axis=1)
+"""
+after linking each decision with one event, ner() extracts name entities from content of event to facilitate name finding.
+The contents are grouped by language and run in batches through nlp.pipe with only the components NER needs.
+The entities are cached on disk per event, language and model version, so every event is only processed once across runs.
+"""
+NER_CACHE_DIR = Path('ner_cache')
+NER_BATCH_SIZE = 64
 
-#after linking each decision with one event, in ner() function I extraxt name entities from content of event to facilate name finding.
-def ner(row):
-    
-    id =int(row["event_id"])
-    lang = (row["language"])
-    content= list(aviation.iloc[[id]]["content"])[0]
-    
-    for i in range(0,len(content)):
-        entities =[]
-        content_lang =content[i]["lang"]
-        if content_lang == lang:
-        
-            doc = content[i]["content"]
-            if lang == "de": 
-                e_doc=de_nlp(doc)
-            elif lang == "fr": 
-                e_doc=fr_nlp(doc)
-            elif lang == "it": 
-                e_doc=it_nlp(doc)
-            elif lang == "en": 
-                e_doc=en_nlp(doc)
-            for ent in e_doc.ents:
-                entities.append(ent.text)
-            row["entities"] = entities   
-        else:
-            continue
-    return row
+#the last content of the event in the language of the decision, None if there is none
+def event_content(content, lang):
+    doc = None
+    for each in content:
+        if each["lang"] == lang:
+            doc = each["content"]
+    return doc
 
-linked_to_aviation = decisions[decisions.event_id.notna()].drop(columns=["text"])
-linked_to_aviation = linked_to_aviation.apply(ner, axis=1)
-datatoexcel1 = pd.ExcelWriter('linked_to_aviation.xlsx')
-linked_to_aviation.to_excel(datatoexcel1,header=True, index=True)
-datatoexcel1.save()
+#the version of the installed model package, so cached entities can be used without loading the model
+def nlp_model_version(lang):
+    try:
+        return importlib.metadata.version(nlp_model_names[lang])
+    except importlib.metadata.PackageNotFoundError:
+        return load_nlp(lang).meta['version']
 
-decisions = decisions[decisions.event_id.isna()]
+def ner_cache_file(name, lang):
+    return NER_CACHE_DIR / f"{name}_{lang}_{nlp_model_names[lang]}-{nlp_model_version(lang)}.json"
 
-#the same process for train data
-trains_and_ships['location_list'] = trains_and_ships.apply(
-    lambda trains_and_ships: clean_data(trains_and_ships.location), axis=1)
-trains_and_ships['details_list'] = trains_and_ships.apply(
-    lambda trains_and_ships: clean_data(trains_and_ships.type), axis=1)
+#the cache files are only read once per process, e.g. in a long-running service
+ner_caches = {}
 
-trains_and_ships['time_pattern'] = trains_and_ships.apply(
-    lambda trains_and_ships: extraxt_content_identifier(trains_and_ships.content,reg_query["time"]), axis=1)
+def event_entities(events, name, event_ids, lang):
+    cache_file = ner_cache_file(name, lang)
+    if cache_file not in ner_caches:
+        ner_caches[cache_file] = {}
+        if cache_file.exists():
+            with open(cache_file, 'r') as f:
+                ner_caches[cache_file] = json.load(f)
+    cache = ner_caches[cache_file]
 
-trains_and_ships['wagon_pattern'] = trains_and_ships.apply(
-    lambda trains_and_ships: extraxt_content_identifier(trains_and_ships.content,reg_query["wagon"]), axis=1)
+    contents = events.set_index("id")["content"]
+    missing = {}
+    for event_id in event_ids:
+        if str(event_id) not in cache:
+            doc = event_content(contents[event_id], lang)
+            if doc is not None:
+                missing[str(event_id)] = doc
+    if missing:
+        nlp = load_nlp(lang)
+        disabled = [pipe for pipe in nlp.pipe_names if pipe not in ("tok2vec", "ner")]
+        e_docs = nlp.pipe(missing.values(), batch_size=NER_BATCH_SIZE, disable=disabled)
+        for event_id, e_doc in zip(missing.keys(), e_docs):
+            cache[event_id] = [ent.text for ent in e_doc.ents]
+        NER_CACHE_DIR.mkdir(exist_ok=True)
+        #other processes (e.g. shards running at the same time) may have added events since, keep their entities
+        if cache_file.exists():
+            with open(cache_file, 'r') as f:
+                for event_id, event_ents in json.load(f).items():
+                    cache.setdefault(event_id, event_ents)
+        #written under a temporary name of this process first, so no process reads a partially written cache
+        partial_file = cache_file.with_suffix(f'.{os.getpid()}.partial')
+        with open(partial_file, 'w') as f:
+            json.dump(cache, f)
+        partial_file.replace(cache_file)
+    return {event_id: cache.get(str(event_id)) for event_id in event_ids}
 
-trains_and_ships['report_number_pattern'] = trains_and_ships.apply(
-    lambda trains_and_ships: extraxt_content_identifier(trains_and_ships.content,reg_query["report_number"]), axis=1)
+def ner(linked, events, name):
+    entities = {}
+    for lang, group in linked.groupby("language"):
+        if lang not in nlp_model_names:
+            continue
+        event_ids = group.event_id.astype(int).unique().tolist()
+        for event_id, found in event_entities(events, name, event_ids, lang).items():
+            entities[(event_id, lang)] = found
+    linked = linked.copy()
+    linked["entities"] = [entities.get((int(event_id), lang))
+                          for event_id, lang in zip(linked.event_id, linked.language)]
+    return linked
+
+train_identifier_columns = ['location_list', 'time_pattern', 'wagon_pattern', 'report_number_pattern']
 
 def get_identifiers_train(text,lang,file_id):
     find_list = []
-    for row in trains_and_ships.iterrows():
+    candidates = event_index(trains_and_ships, "trains_and_ships", lang, train_identifier_columns).candidates(text)
+    if DATE_BLOCKING:
+        candidates = block_by_date(trains_and_ships, "trains_and_ships", candidates, text)
+    for row in trains_and_ships.iloc[candidates].iterrows():
         score = 0
         kw = []
         id = row[1]["id"]  
@@ -313,54 +583,523 @@ def get_identifiers_train(text,lang,file_id):
         
         matched_date =find_match(date_key,text)
         if  matched_date is not None:
-            score = len(matched_date) * 2 + score
+            score = len(matched_date) * train_weights["date"] + score
             kw.append(matched_date)
         matched_loc =find_match(loc,text)
         if  matched_loc is not None:
-            score = len(matched_loc) * 1 + score
+            score = len(matched_loc) * train_weights["location_list"] + score
             kw.append(matched_loc)
         if  report_number is not None:
             matched_report_number =find_match(report_number,text)
             if  matched_report_number is not None:
-                score = len(matched_report_number) * 3 + score
+                score = len(matched_report_number) * train_weights["report_number_pattern"] + score
                 kw.append(matched_report_number)
         else:
             pass
         if  time is not None:
             matched_time =find_match(time,text)
             if  matched_time is not None:
-                score = len(matched_time) * 2 + score
+                score = len(matched_time) * train_weights["time_pattern"] + score
                 kw.append(matched_time)
         else:
             pass
         if  wagon is not None:
             matched_pist =find_match(wagon,text)
             if  matched_pist is None:
-                new_wagon =[]
-                for item in wagon:
-                    new_wagon.append(item.replace('n°','n&#176;'))
-   
-            matched_pist =find_match(new_wagon,text)   
+                matched_pist =find_match(wagon_variants(wagon),text)
             if  matched_pist is not None:    
                 
-                score = len(matched_pist) * 1 + score
+                score = len(matched_pist) * train_weights["wagon_pattern"] + score
                 kw.append(matched_pist)
         else:
             pass
         find_list.append([id,score,kw])
     
+    if not find_list:
+        return None
     max_score = max(find_list, key=lambda x: x[1])
-    if max_score[1] > 3:
+    if max_score[1] > thresholds["trains_and_ships"]:
         return max_score[0]
     else:
         return None
 
-decisions['event_id'] = decisions.apply(
-    lambda decision: get_identifiers_train(decision.text, decision.language,decision.file_id), axis=1)
+"""
+Sparse scoring engine: the identifiers of an event table become a vocabulary of terms, one per identifier kind and
+lowercased identifier. Every event is a binary row over these terms and every decision of a batch a binary row of the
+terms found in its text, so the hits per identifier kind of all decision x event pairs come from one sparse matrix
+product per kind. They are weighted with aviation_weights / train_weights, and the linked event is the first event
+with the highest score above the threshold among the date-blocked candidates. get_identifiers / get_identifiers_train
+are the per-decision version of this scoring with find_match and read the same weights and thresholds; the scores are
+equal, except when identifiers of one kind overlap in a text or the dot of a report number matches another character.
+"""
+aviation_weights = {"date": 3, "location_list": 1, "details_list": 2, "report_number_pattern": 3, "time_pattern": 2,
+                    "pist_pattern": 1}
+train_weights = {"date": 2, "location_list": 1, "report_number_pattern": 3, "time_pattern": 2, "wagon_pattern": 1}
+thresholds = {"aviation": 4, "trains_and_ships": 3}
+
+class SparseScorer:
+    def __init__(self, events, lang, weights):
+        self.weights = weights
+        terms = {}
+        self.patterns = []
+        term_kinds = []
+        rows, columns = [], []
+        #find_match with an empty identifier list matches the empty string, which adds the weight once
+        self.bias = np.zeros(len(events.index))
+        self.empty = {kind: np.zeros(len(events.index), dtype=bool) for kind in weights.keys()}
+        for position, (_, event) in enumerate(events.iterrows()):
+            for kind, weight in weights.items():
+                identifiers = convert_date(event["event_date"], lang) if kind == "date" else event[kind]
+                if identifiers is None:
+                    continue
+                if len(identifiers) == 0:
+                    self.bias[position] += weight
+                    self.empty[kind][position] = True
+                    continue
+                for identifier in {identifier.lower() for identifier in identifiers}:
+                    if (kind, identifier) not in terms:
+                        terms[(kind, identifier)] = len(terms)
+                        variants = wagon_variants([identifier]) if kind == "wagon_pattern" else []
+                        self.patterns.append(tuple([identifier] + variants))
+                        term_kinds.append(kind)
+                    rows.append(position)
+                    columns.append(terms[(kind, identifier)])
+        self.term_index = EventIndex(self.patterns)
+        #compiled once per term, the scorers of all tables and languages would not fit in the pattern cache
+        self.compiled = [identifier_pattern(patterns) for patterns in self.patterns]
+        event_terms = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(events.index), len(terms)))
+        term_kinds = np.array(term_kinds, dtype=object)
+        self.kind_terms = {}
+        for kind in weights.keys():
+            kind_columns = np.flatnonzero(term_kinds == kind)
+            self.kind_terms[kind] = (kind_columns, event_terms[:, kind_columns].T.tocsr())
+
+    #binary decision x term matrix, the term index gives the terms that can match and the patterns confirm them
+    def hits(self, texts):
+        rows, columns = [], []
+        for row, text in enumerate(texts):
+            for column in self.term_index.candidates(text):
+                if self.compiled[column].search(text):
+                    rows.append(row)
+                    columns.append(column)
+        return sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(texts), len(self.patterns)))
+
+    #number of identifiers found per kind and the weighted score, both as sparse decision x event matrices
+    def scores(self, texts):
+        hits = self.hits(texts)
+        counts = {kind: (hits[:, kind_columns] @ kind_events).tocsr()
+                  for kind, (kind_columns, kind_events) in self.kind_terms.items()}
+        total = sparse.csr_matrix((len(texts), len(self.bias)))
+        for kind, weight in self.weights.items():
+            total = total + weight * counts[kind]
+        return total.tocsr(), counts
+
+scorers = {}
+
+def scorer(name, lang):
+    if (name, lang) not in scorers:
+        weights = aviation_weights if name == "aviation" else train_weights
+        scorers[(name, lang)] = SparseScorer(event_table(name), lang, weights)
+    return scorers[(name, lang)]
+
+def event_table(name):
+    return aviation if name == "aviation" else trains_and_ships
+
+#decision x event matrix of the events on a date found in the decision
+def date_mask(name, texts):
+    events_by_date, _ = date_block(event_table(name), name)
+    rows, columns = [], []
+    for row, text in enumerate(texts):
+        for date in decision_dates(text):
+            for position in events_by_date.get(date, ()):
+                rows.append(row)
+                columns.append(position)
+    mask = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(texts), len(event_table(name).index)))
+    mask.data[:] = 1
+    return mask
+
+#the position and score of the linked event per decision, the first event with the highest score among the candidates
+def select_events(name, total, counts, texts, bias):
+    shortlist = total
+    if DATE_BLOCKING:
+        shortlist = total.multiply(date_mask(name, texts)).tocsr()
+        shortlist.eliminate_zeros()
+        without_date = sparse.diags((shortlist.getnnz(axis=1) == 0).astype(float))
+        report_candidates = total.multiply(counts["report_number_pattern"] > 0)
+        shortlist = shortlist + without_date @ report_candidates
+    shortlist = sparse.csr_matrix(shortlist)
+    shortlist.eliminate_zeros()
+    shortlist.sum_duplicates()
+    shortlist.data += bias[shortlist.indices]
+    best = np.asarray(shortlist.argmax(axis=1)).ravel()
+    best_score = shortlist.max(axis=1).toarray().ravel()
+    return best, best_score, shortlist
+
+"""
+Score tables: instead of keeping only the best event, the linking can keep the top_k events of the shortlist of every
+decision with their score and the number of identifiers found per kind. An empty identifier list counts as one hit,
+like the bias of the scorer, so the score is the sum of weight x hits over the kinds. relink() picks the linked
+events again from such a table for other weights and thresholds without scanning the decisions. Only the events
+in the top_k under the weights of the run are kept, so choose top_k large enough for the weights you want to try.
+"""
+score_kinds = ["date", "location_list", "details_list", "report_number_pattern", "time_pattern", "pist_pattern",
+               "wagon_pattern"]
+
+def top_events(name, lang_scorer, counts, shortlist, top_k):
+    rows, positions, scores = [], [], []
+    for row in range(shortlist.shape[0]):
+        start, end = shortlist.indptr[row], shortlist.indptr[row + 1]
+        indices, data = shortlist.indices[start:end], shortlist.data[start:end]
+        #the highest scores first, the first event among equal scores
+        for index in np.lexsort((indices, -data))[:top_k]:
+            rows.append(row)
+            positions.append(indices[index])
+            scores.append(data[index])
+    #typed, so that the table of a batch without candidate events still has integer rows and positions
+    rows, positions = np.asarray(rows, dtype=int), np.asarray(positions, dtype=int)
+    scores = np.asarray(scores, dtype=float)
+    table = DataFrame({"row": rows, "name": name, "event_id": event_table(name)["id"].to_numpy()[positions],
+                       "position": positions, "score": scores})
+    for kind in score_kinds:
+        if kind not in counts:
+            table[kind] = 0
+            continue
+        hits = np.asarray(counts[kind][rows, positions]).ravel() if len(rows) else np.zeros(0)
+        table[kind] = (hits + lang_scorer.empty[kind][positions]).astype(int)
+    return table
+
+#event ids (or None) for a batch of decision texts, linked to the event table name, and with a top_k the score table
+def link_to_events(name, texts, langs, top_k=0):
+    event_ids = event_table(name)["id"].tolist()
+    linked = [None] * len(texts)
+    tables = []
+    for lang in sorted(set(langs)):
+        positions = [position for position, decision_lang in enumerate(langs) if decision_lang == lang]
+        lang_texts = [texts[position] for position in positions]
+        with profiler.stage('build_scorers'):
+            lang_scorer = scorer(name, lang)
+        with profiler.stage('extract_identifiers', len(lang_texts)):
+            total, counts = lang_scorer.scores(lang_texts)
+        with profiler.stage('select_events', len(lang_texts)):
+            best, best_score, shortlist = select_events(name, total, counts, lang_texts, lang_scorer.bias)
+        for position, event, score in zip(positions, best, best_score):
+            if score > thresholds[name]:
+                linked[position] = event_ids[event]
+        if top_k:
+            table = top_events(name, lang_scorer, counts, shortlist, top_k)
+            table["row"] = np.asarray(positions, dtype=int)[table["row"].to_numpy()]
+            tables.append(table)
+    if top_k:
+        return linked, pd.concat(tables, ignore_index=True) if tables else None
+    return linked
+
+#the linked event_id (or None) per file_id for the scores of a score table and other weights or thresholds
+def relink(scores, weights=None, relink_thresholds=None):
+    weights = {"aviation": aviation_weights, "trains_and_ships": train_weights, **(weights or {})}
+    relink_thresholds = {**thresholds, **(relink_thresholds or {})}
+    linked = {}
+    for name in ("aviation", "trains_and_ships"):
+        table = scores[(scores["name"] == name) & ~scores["file_id"].isin(list(linked))]
+        score = sum(weight * table[kind] for kind, weight in weights[name].items())
+        table = table.assign(score=score)[score > relink_thresholds[name]]
+        best = table.sort_values(["file_id", "score", "position"], ascending=[True, False, True], kind="stable")
+        best = best.drop_duplicates("file_id")
+        linked.update({file_id: (name, event_id) for file_id, event_id in zip(best["file_id"], best["event_id"])})
+    return DataFrame([(file_id, name, event_id) for file_id, (name, event_id) in linked.items()],
+                     columns=["file_id", "linked_to", "event_id"])
+
+#--weight TABLE.KIND=WEIGHT and --threshold TABLE=THRESHOLD of relink, checked against the tables and score_kinds
+def parse_weight(spec):
+    key, _, value = spec.partition('=')
+    name, _, kind = key.partition('.')
+    if name not in thresholds or kind not in score_kinds:
+        raise argparse.ArgumentTypeError(f"expected TABLE.KIND=WEIGHT with TABLE one of {', '.join(thresholds)} and "
+                                         f"KIND one of {', '.join(score_kinds)}, got {spec}")
+    try:
+        return name, kind, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"the weight must be a number, got {spec}")
+
+def parse_threshold(spec):
+    name, _, value = spec.partition('=')
+    if name not in thresholds:
+        raise argparse.ArgumentTypeError(f"expected TABLE=THRESHOLD with TABLE one of {', '.join(thresholds)}, "
+                                         f"got {spec}")
+    try:
+        return name, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"the threshold must be a number, got {spec}")
+
+"""
+Scoring a decision does not depend on any other decision, so the linking can be spread over a process pool.
+The event tables and their scorers are built once in the parent process and handed to the workers: with fork they
+are shared copy-on-write, otherwise they are pickled once per worker. Pool.starmap keeps the order of the batches,
+so the linked event_ids are the same as in the serial path.
+"""
+def build_indexes():
+    for lang in dic.keys():
+        scorer("aviation", lang)
+        scorer("trains_and_ships", lang)
+    date_block(aviation, "aviation")
+    date_block(trains_and_ships, "trains_and_ships")
+
+def init_worker(events, built_scorers, blocks):
+    global aviation, trains_and_ships
+    aviation, trains_and_ships = events
+    scorers.update(built_scorers)
+    date_blocks.update(blocks)
+
+def make_pool(workers):
+    build_indexes()
+    method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+    return multiprocessing.get_context(method).Pool(
+        workers, initializer=init_worker, initargs=((aviation, trains_and_ships), scorers, date_blocks))
+
+#the decisions are split into 4 chunks per worker of the pool
+def find_events(name, decisions, pool=None, top_k=0, workers=1):
+    texts, langs = decisions.text.tolist(), decisions.language.tolist()
+    if pool is None:
+        return link_to_events(name, texts, langs, top_k)
+    size = max(1, -(-len(texts) // (4 * workers)))
+    starts = range(0, len(texts), size)
+    results = pool.starmap(link_to_events, [(name, texts[start:start + size], langs[start:start + size], top_k)
+                                            for start in starts])
+    if not top_k:
+        return [event_id for linked in results for event_id in linked]
+    tables = [table.assign(row=table["row"] + start) for start, (_, table) in zip(starts, results) if table is not None]
+    return ([event_id for linked, _ in results for event_id in linked],
+            pd.concat(tables, ignore_index=True) if tables else None)
+
+"""
+Incremental runs: the linking result of every decision is stored in SQLite with the hash of its text and the version
+of the event data (the hash of both event files and the linking settings). A later run only links new or changed
+decisions, and all decisions again once aviatik.json or bahnen_und_schiffe.json changed.
+"""
+def data_version():
+    return file_hash(*[DATA_DIR / file for file in event_files],
+                     settings=[f"DATE_BLOCKING={DATE_BLOCKING}", f"NORMALIZE_TEXT={NORMALIZE_TEXT}",
+                               f"PREPARE_VERSION={PREPARE_VERSION}"])
+
+#the stored results of the decisions whose text and event data did not change, by position in the batch
+def reusable_results(store, decisions):
+    found = store.get([str(file_id) for file_id in decisions.file_id])
+    reusable = {}
+    for position, (file_id, text) in enumerate(zip(decisions.file_id, decisions.text)):
+        hash_, version, result = found.get(str(file_id), (None, None, None))
+        if version == store.data_version and hash_ == text_hash(text):
+            reusable[position] = result
+    return reusable
+
+#link a batch of decisions first to aviation events and the remaining ones to train and ship events, without the texts
+#with a scores writer, the top_k events of both tables are written for every decision (see relink)
+def link_decisions(decisions, pool=None, store=None, scores=None, top_k=10, workers=1):
+    decisions = decisions.copy()
+    reusable = reusable_results(store, decisions) if store is not None else {}
+    event_ids = [reusable[position]["event_id"] if position in reusable else None for position in range(len(decisions.index))]
+    linked_to = [reusable[position]["linked_to"] if position in reusable else None for position in range(len(decisions.index))]
+
+    new = [position for position in range(len(decisions.index)) if position not in reusable]
+    pending = new
+    for name in ("aviation", "trains_and_ships"):
+        with profiler.stage('link_' + name, len(pending)):
+            if scores is not None:
+                #the decisions linked to aviation events also need their train scores for other thresholds
+                found, table = find_events(name, decisions.iloc[new], pool, top_k, workers)
+                if table is not None:
+                    table.insert(0, "file_id", decisions["file_id"].to_numpy()[np.asarray(new)[table.pop("row")]])
+                    scores.write(table)
+                found = dict(zip(new, found))
+                found = [found[position] for position in pending]
+            else:
+                found = find_events(name, decisions.iloc[pending], pool, workers=workers)
+        for position, event_id in zip(pending, found):
+            event_ids[position] = event_id
+            linked_to[position] = name if event_id is not None else None
+        pending = [position for position, event_id in zip(pending, found) if event_id is None]
+
+    if store is not None:
+        store.put([(str(file_id), text_hash(text), {"event_id": event_ids[position], "linked_to": linked_to[position]})
+                   for position, file_id, text in zip(new, decisions.file_id.iloc[new], decisions.text.iloc[new])])
+    decisions['event_id'] = event_ids
+    decisions = decisions.drop(columns=["text"])
+    linked_to = np.array(linked_to, dtype=object)
+    linked_to_aviation = decisions[linked_to == "aviation"]
+    linked_to_train = decisions[linked_to == "trains_and_ships"]
+    return linked_to_aviation, linked_to_train
+
+"""
+The linked decisions are written batch by batch as soon as a batch is linked and its entities are found, so the
+results of the whole corpus are never kept in memory. CSV and JSON lines files are appended to, parquet files get one
+row group per batch. The Excel files of earlier versions are an optional post-processing step (--excel), because
+building an xlsx workbook is by far the slowest way to write the results.
+"""
+OUTPUT_DIR = Path('.')
+
+#converts a written result file to the xlsx file of earlier versions
+def write_excel(path, output_format):
+    if not path.with_suffix('.' + output_format).exists():
+        return
+    result_writers[output_format].read(path).to_excel(path.with_suffix('.xlsx'), header=True, index=True)
+
+"""
+Sharded runs (see shared/sharding.py): the decisions are sharded by file_id, a shard links them, finds their entities
+and writes them to shards/, it is only complete once its done file is written. The merge restores the order of
+decisions.csv.
+"""
+SHARD_DIR = OUTPUT_DIR / 'shards'
+
+def shard_path(path, index, count):
+    return SHARD_DIR / f"{path.name}-{index}-of-{count}"
+
+def shard_done(index, count):
+    return SHARD_DIR / f"done-{index}-of-{count}"
+
+#the linked decisions of all shards in the order of decisions.csv, a shard without linked decisions has no file
+def merge_shards(path, count):
+    missing = [index for index in range(count) if not shard_done(index, count).exists()]
+    if missing:
+        raise FileNotFoundError(f"the shards {missing} of {count} have not been completed (yet)")
+    files = [shard_path(path, index, count).with_suffix('.parquet') for index in range(count)]
+    parts = [pd.read_parquet(file) for file in files if file.exists()]
+    if not parts:
+        return None
+    linked = pd.concat(parts).sort_index(kind='stable')
+    linked["entities"] = [json.loads(value) if isinstance(value, str) else None for value in linked["entities"]]
+    return linked
+
+profiled_stages = ['load_events', 'stsb_events', 'clean_data', 'extraxt_content_identifier', 'prepare_decisions',
+                   'build_scorers', 'extract_identifiers', 'select_events', 'link_aviation', 'link_trains_and_ships',
+                   'ner', 'write_results', 'excel', 'relink', 'merge_shards']
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-identify Swiss court decisions with events from STSB")
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help="read and link the decisions in batches of this many rows, "
+                             "so peak memory depends on the batch size and not on the corpus size")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes used to link the decisions to events")
+    parser.add_argument('--store', default=None,
+                        help="SQLite file with the results of earlier runs, only new or changed decisions are linked")
+    parser.add_argument('--output-format', choices=sorted(result_writers), default='parquet',
+                        help="file format of linked_to_aviation and linked_to_train, written batch by batch")
+    parser.add_argument('--excel', action='store_true',
+                        help="additionally convert the written results to linked_to_aviation.xlsx and linked_to_train.xlsx")
+    parser.add_argument('--profile', default='run_profile.json',
+                        help="JSON file with the wall time, CPU time, peak RSS and rows of every stage of the run")
+    parser.add_argument('--cprofile', default=None, choices=profiled_stages,
+                        help="additionally run this stage under cProfile, the stats are written next to the profile")
+    parser.add_argument('--scores', default=None,
+                        help="parquet file for the top-k events of every decision with their score and hits per kind")
+    parser.add_argument('--top-k', type=int, default=10, help="number of events per decision and table in --scores")
+    parser.add_argument('--relink', default=None,
+                        help="only link the decisions again from this score table, with --weight and --threshold")
+    parser.add_argument('--weight', type=parse_weight, action='append', default=[], metavar='TABLE.KIND=WEIGHT',
+                        help="weight of an identifier kind for --relink, e.g. aviation.date=4")
+    parser.add_argument('--threshold', type=parse_threshold, action='append', default=[], metavar='TABLE=THRESHOLD',
+                        help="score an event needs to be linked for --relink, e.g. trains_and_ships=4")
+    parser.add_argument('--shard', type=parse_shard, default=None, metavar='INDEX/COUNT',
+                        help="only link the decisions of shard INDEX (0-based) of COUNT and write them to shards/")
+    parser.add_argument('--merge', type=int, default=None, metavar='COUNT',
+                        help="merge the linked decisions of COUNT shards into linked_to_aviation and linked_to_train")
+    args = parser.parse_args()
+    if args.scores and args.store:
+        parser.error("--scores needs all decisions to be scored, it cannot be combined with --store")
+    profiler.cprofile_stage = args.cprofile
+
+    if args.relink:
+        weights = {"aviation": dict(aviation_weights), "trains_and_ships": dict(train_weights)}
+        for name, kind, value in args.weight:
+            weights[name][kind] = value
+        relink_thresholds = dict(args.threshold)
+        with profiler.stage('relink') as stage:
+            scores = pd.read_parquet(args.relink)
+            linked = relink(scores, weights, relink_thresholds)
+            stage["rows"] = scores["file_id"].nunique()
+        linked.to_csv(OUTPUT_DIR / 'relinked.csv', index=False)
+        print(f"Linked {int((linked.linked_to == 'aviation').sum())} decisions to aviation events and "
+              f"{int((linked.linked_to == 'trains_and_ships').sum())} to train and ship events")
+        profiler.write(Path(args.profile), pipeline='stsb', args=vars(args))
+        return
+
+    outputs = {"aviation": OUTPUT_DIR / 'linked_to_aviation', "trains_and_ships": OUTPUT_DIR / 'linked_to_train'}
+    if args.merge:
+        for path in outputs.values():
+            with profiler.stage('merge_shards') as stage:
+                linked = merge_shards(path, args.merge)
+                stage["rows"] = 0 if linked is None else len(linked.index)
+            if linked is not None:
+                with profiler.stage('write_results', len(linked.index)):
+                    writer = result_writers[args.output_format](path)
+                    writer.write(linked)
+                    writer.close()
+            if args.excel:
+                with profiler.stage('excel'):
+                    write_excel(path, args.output_format)
+        profiler.write(Path(args.profile), pipeline='stsb', args=vars(args))
+        return
+
+    with profiler.stage('load_events'):
+        load_events()
+
+    store = ResultStore(args.store, data_version(), key_column='file_id') if args.store else None
+    scores_path = Path(args.scores) if args.scores else None
+    if scores_path is not None and args.shard:
+        scores_path = scores_path.with_name(f"{scores_path.stem}-{args.shard[0]}-of-{args.shard[1]}")
+    scores = ParquetWriter(scores_path) if scores_path is not None else None
+    pool = make_pool(args.workers) if args.workers > 1 else None
+    if args.shard:
+        #written under a temporary name first, see merge_shards
+        SHARD_DIR.mkdir(parents=True, exist_ok=True)
+        shard_done(*args.shard).unlink(missing_ok=True)
+        writers = {name: ParquetWriter(SHARD_DIR / f"{shard_path(path, *args.shard).name}-partial")
+                   for name, path in outputs.items()}
+    else:
+        writers = {name: result_writers[args.output_format](path) for name, path in outputs.items()}
+    languages = pd.Series(dtype=int)
+    for batch in profiler.batches('prepare_decisions', prepare_decisions(args.chunksize)):
+        if args.shard:
+            batch = batch[shard_of(batch.file_id, args.shard[1]) == args.shard[0]]
+        languages = languages.add(batch.language.value_counts(), fill_value=0)
+        aviation_batch, train_batch = link_decisions(batch, pool, store, scores, args.top_k, args.workers)
+        for name, events, linked in (("aviation", aviation, aviation_batch),
+                                     ("trains_and_ships", trains_and_ships, train_batch)):
+            if len(linked.index):
+                with profiler.stage('ner', len(linked.index)):
+                    linked = ner(linked, events, name)
+                with profiler.stage('write_results', len(linked.index)):
+                    writers[name].write(linked)
+    for name, writer in writers.items():
+        writer.close()
+        if args.shard:
+            final = shard_path(outputs[name], *args.shard).with_suffix('.parquet')
+            final.unlink(missing_ok=True)
+            if writer.path.exists():
+                writer.path.replace(final)
+    if scores is not None:
+        scores.close()
+    if args.shard:
+        shard_done(*args.shard).touch()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    else:
+        print(f"Identifier pattern cache after linking: {compile_identifiers.cache_info()}")
+
+    num_decisions = int(languages.sum())
+    print(f"Found {num_decisions} decisions containing at least one of the following terms SUST,STSB,SISI,SESE")
+    print(f"Found {int(languages.get('de', 0))} decisions in German languages")
+    print(f"Found {int(languages.get('fr', 0))} decisions in French languages")
+    print(f"Found {int(languages.get('it', 0))} decisions in Italian languages")
+
+    if args.excel and not args.shard:
+        with profiler.stage('excel'):
+            for path in outputs.values():
+                write_excel(path, args.output_format)
 
-linked_to_train = decisions[decisions.event_id.notna()].drop(columns=["text"])
-linked_to_train= linked_to_train.apply(ner, axis=1)
+    profile = Path(args.profile)
+    if args.shard:
+        profile = profile.with_name(f"{profile.stem}-{args.shard[0]}-of-{args.shard[1]}{profile.suffix}")
+    profiler.write(profile, pipeline='stsb', args=vars(args))
 
-datatoexcel2 = pd.ExcelWriter('linked_to_train.xlsx')
-linked_to_train.to_excel(datatoexcel2,header=True, index=True)
-datatoexcel2.save()
+if __name__ == '__main__':
+    main()